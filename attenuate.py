@@ -1,7 +1,7 @@
 import numpy as np
 import math
 
-def attenuate(original_energy, coeff, depth):
+def attenuate(original_energy, coeff, depth, dtype=float, out=None):
 	"""calculates residual photons for a particular material and depth
 	attenuate(original_energy, coeff, depth, mas) takes the original_energy
 	(energy, samples) and works out the residual_energy (energy, samples)
@@ -10,6 +10,10 @@ def attenuate(original_energy, coeff, depth):
 
 	It is more efficient to calculate this for a range of samples rather then
 	one at a time
+
+	The result is worked out in place in out (energy, samples), if given,
+	and otherwise in a new array of type dtype, such as np.float32 to halve
+	the memory used.
 	"""
 
 	# check original energy is energy x samples
@@ -39,6 +43,11 @@ def attenuate(original_energy, coeff, depth):
 		raise ValueError('input depth has different number of samples to input original_energy')
 
 	# Work out residual energy for each depth and at each energy
-	original_energy = original_energy * np.exp(-np.outer(coeff, depth))
+	if out is None:
+		out = np.empty((energies, samples), dtype=dtype)
+	np.multiply(coeff[:, np.newaxis], depth, out=out)
+	np.negative(out, out=out)
+	np.exp(out, out=out)
+	out *= original_energy
 
-	return original_energy
\ No newline at end of file
+	return out
\ No newline at end of file
@@ -2,46 +2,291 @@ import numpy as np
 import math
 import scipy
 from scipy import interpolate
-import sys
+import functools
+import concurrent.futures
+from ct_trace import progress
 
-def back_project(sinogram, skip=1):
+@functools.lru_cache(maxsize=16)
+def rotations(angles):
+	"""cosp, sinp = rotations(angles) returns read-only tables of the cosine
+	and sine of the back-projection rotation for each of the given number of
+	angles, which are shared between calls"""
+
+	cosp = np.array([math.cos(math.pi / 2 + angle * math.pi / angles) for angle in range(angles)])
+	sinp = np.array([math.sin(math.pi / 2 + angle * math.pi / angles) for angle in range(angles)])
+	cosp.flags.writeable = False
+	sinp.flags.writeable = False
+
+	return cosp, sinp
+
+def back_project(sinogram, skip=1, projector=None, chunk=None, out=None, workers=None):
 
 	"""back_project back-projection to reconstruct CT data
 	back_project(sinogram) back-projects the filtered sinogram
 	(angles x samples) to create the reconstruted data (samples x
-	samples)"""
+	samples)
+
+	back_project(sinogram, skip, projector) uses the given Projector (see
+	get_projector) to back-project all angles with a single sparse matrix
+	product, which is faster when the same geometry is used many times.
+
+	back_project(sinogram, skip, None, chunk) back-projects chunk angles at
+	a time, interpolating all of them together and accumulating in place into
+	the output, which avoids allocating new arrays for every angle.
+
+	sinogram can also be a stack of sinograms (slices x angles x samples),
+	in which case the output is a volume (slices x samples x samples). Each
+	chunk of rotated coordinates is then worked out once and used for every
+	slice, with chunk defaulting to 16 angles.
+
+	back_project(sinogram, skip, projector, chunk, out) writes the output to
+	out, which must be a contiguous array of the right size. Single precision
+	sinograms are back-projected, and returned, in single precision.
+
+	back_project(sinogram, skip, projector, chunk, out, workers) back-projects
+	chunks of angles in parallel using a pool of workers threads, with chunk
+	defaulting to 16 angles. The result is exactly the same for any workers
+	of 1 or more, and as without workers for the same chunk, but differs by
+	rounding from the loop over each angle which a single sinogram uses
+	when neither chunk nor workers is given.
+
+	For images which are too large to back-project at once, use
+	back_project_tiled."""
+
+	if projector is not None:
+		if (projector.angles, projector.n, projector.skip) != (sinogram.shape[-2], sinogram.shape[-1], skip):
+			raise ValueError('projector has different geometry to input sinogram')
+		if sinogram.ndim == 3:
+			reconstruction = np.array([projector.back(s) for s in sinogram])
+		else:
+			reconstruction = projector.back(sinogram)
+		if out is None:
+			return reconstruction.astype(sinogram.dtype if sinogram.dtype.kind == 'f' else float, copy=False)
+		out[...] = reconstruction
+		return out
 
 	# get input dimensions
-	ns = sinogram.shape[1]
-	angles = sinogram.shape[0]
+	ns = sinogram.shape[-1]
+	angles = sinogram.shape[-2]
 	n = int(math.floor((ns-1) // skip) + 1)
 
 	# zero output and form input coordinates
 	# these have centre in the middle of the image
-	reconstruction = np.zeros((n, n))
+	shape = (sinogram.shape[0], n, n) if sinogram.ndim == 3 else (n, n)
+	if out is None:
+		reconstruction = np.zeros(shape, dtype=sinogram.dtype if sinogram.dtype.kind == 'f' else float)
+	elif (out.shape != shape) or not out.flags.c_contiguous:
+		raise ValueError('out must be a contiguous array of the same size as the reconstruction')
+	else:
+		reconstruction = out
+		reconstruction[...] = 0
+	if ((sinogram.ndim == 3) or (workers is not None)) and (chunk is None):
+		chunk = 16
 	xi, yi = np.meshgrid(np.arange(0,ns,skip) - (ns/2) + 0.5, np.arange(0,ns,skip) - (ns/2) + 0.5)
 
-	# back project over each angle in turn
-	for angle in range(angles):
-		sys.stdout.write("Reconstructing angle: %d   \r" % (angle + 1) )
+	if chunk is not None:
+		back_project_chunked(sinogram, skip, chunk, reconstruction, workers=workers)
+	else:
+		# back project over each angle in turn
+		for angle in range(angles):
+			progress('back_project', angle + 1, angles)
 		
-		# Form rotated coordinates for output interpolation
-		# the rotation is about the middle of the image,
-		# but the output coordinates need to be relative to the top left
-		p = math.pi / 2 + angle * math.pi / angles
-		x0 = xi * math.cos(p) - yi * math.sin(p) + (ns / 2) - 0.5
+			# Form rotated coordinates for output interpolation
+			# the rotation is about the middle of the image,
+			# but the output coordinates need to be relative to the top left
+			p = math.pi / 2 + angle * math.pi / angles
+			x0 = xi * math.cos(p) - yi * math.sin(p) + (ns / 2) - 0.5
 		
-		# interpolate and add this data to output
-		# remembering to multiply by dtheta as well as sum
-		# Either of the following options will work
-		# x2 = scipy.interpolate.interp1d(np.arange(0, ns, 1), sinogram[angle], kind='linear', copy=False, assume_sorted=True, bounds_error=False, fill_value=0, axis=0)
-		# reconstruction = reconstruction + x2(x0) * (math.pi / angles)
-		x2 = scipy.ndimage.map_coordinates(sinogram[angle], [x0], order=1, mode='constant', cval=0, prefilter=False)
-		reconstruction = reconstruction + x2 * (math.pi / angles)
+			# interpolate and add this data to output
+			# remembering to multiply by dtheta as well as sum
+			# Either of the following options will work
+			# x2 = scipy.interpolate.interp1d(np.arange(0, ns, 1), sinogram[angle], kind='linear', copy=False, assume_sorted=True, bounds_error=False, fill_value=0, axis=0)
+			# reconstruction = reconstruction + x2(x0) * (math.pi / angles)
+			x2 = scipy.ndimage.map_coordinates(sinogram[angle], [x0], order=1, mode='constant', cval=0, prefilter=False)
+			reconstruction += x2 * (math.pi / angles)
 
 	# ensure any data outside the reconstructed circle is set to invalid
-	reconstruction[np.where((xi ** 2 + yi ** 2) > (ns/2)**2)] = -1
+	reconstruction[..., (xi ** 2 + yi ** 2) > (ns/2)**2] = -1
+
+	return reconstruction
+
+def back_project_chunked(sinogram, skip, chunk, reconstruction, rows=None, columns=None, workers=None):
+
+	"""back_project_chunked(sinogram, skip, chunk, reconstruction) adds the
+	back-projection of sinogram (angles x samples) into reconstruction,
+	interpolating chunk angles at a time into buffers which are reused for
+	every chunk. The result is the same as the loop in back_project.
+
+	sinogram and reconstruction can also be stacks of slices, (slices x
+	angles x samples) and (slices x n x n), which share the same
+	interpolation coordinates. The interpolation is worked out with the
+	same type as reconstruction.
+
+	back_project_chunked(sinogram, skip, chunk, reconstruction, rows,
+	columns) only works out the part of the image with the given row and
+	column coordinates, relative to the centre of the image, into
+	reconstruction (len(rows) x len(columns)), which is used for tiles.
+
+	If workers is given, the rows are split into bands which are
+	back-projected by a pool of that many threads, each with its own
+	buffers and writing only to its own rows of reconstruction. Each pixel
+	is summed in the same order, so the result does not depend on workers,
+	and the buffers together are the same size as without workers."""
+
+	# get input dimensions, treating a single sinogram as one slice
+	ns = sinogram.shape[-1]
+	angles = sinogram.shape[-2]
+	sinogram = sinogram.reshape((-1, angles, ns))
+	chunk = max(1, min(int(chunk), angles))
+
+	r = np.arange(0, ns, skip) - (ns/2) + 0.5
+	if rows is None:
+		rows = r
+	if columns is None:
+		columns = r
+	h, w = len(rows), len(columns)
+	reconstruction = reconstruction.reshape((-1, h, w))
+	dtype = reconstruction.dtype
+	flat = np.ascontiguousarray(sinogram, dtype=dtype).reshape((sinogram.shape[0], -1))
+
+	if (workers is None) or (workers <= 1) or (h <= 1):
+		_back_project_rows(flat, angles, ns, chunk, rows, columns, reconstruction, True)
+		return
+
+	bands = [(b[0], b[-1] + 1) for b in np.array_split(np.arange(h), min(workers, h))]
+	with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+		done = pool.map(lambda b: _back_project_rows(flat, angles, ns, chunk, rows[b[0]:b[1]], columns,
+			reconstruction[:, b[0]:b[1]], False), bands)
+		for band, _ in enumerate(done):
+			progress('back_project', band + 1, len(bands))
+
+def _back_project_rows(flat, angles, ns, chunk, rows, columns, reconstruction, report):
+
+	"""_back_project_rows(flat, angles, ns, chunk, rows, columns,
+	reconstruction, report) adds the back-projection of the flattened
+	sinograms flat (slices x angles*ns) into reconstruction (slices x
+	len(rows) x len(columns)) for back_project_chunked, reporting progress
+	after each chunk if report is True"""
+
+	# the rotated coordinate is separable, x0 = xi * cos(p) - yi * sin(p),
+	# where xi only varies along columns and yi only along rows
+	h, w = len(rows), len(columns)
+	cosp, sinp = rotations(angles)
+	dtype = reconstruction.dtype
+
+	# working buffers, reused for each chunk
+	x0 = np.empty((chunk, h, w), dtype=dtype)
+	lower = np.empty((chunk, h, w), dtype=np.intp)
+	upper = np.empty((chunk, h, w), dtype=np.intp)
+	valid = np.empty((chunk, h, w), dtype=bool)
+	outside = np.empty((chunk, h, w), dtype=bool)
+	values = np.empty((chunk, h, w), dtype=dtype)
+	upper_values = np.empty((chunk, h, w), dtype=dtype)
+	partial = np.empty((h, w), dtype=dtype)
+
+	for start in range(0, angles, chunk):
+		stop = min(start + chunk, angles)
+		c = stop - start
+		x, l, u, v, o = x0[:c], lower[:c], upper[:c], valid[:c], outside[:c]
+		y0, y1 = values[:c], upper_values[:c]
+
+		# Form rotated coordinates for output interpolation, relative to the top left
+		np.subtract(np.outer(cosp[start:stop], columns)[:, None, :], np.outer(sinp[start:stop], rows)[:, :, None], out=x)
+		x += ns / 2
+		x -= 0.5
+
+		# linear interpolation, with zero outside the samples
+		np.greater_equal(x, 0, out=v)
+		np.less_equal(x, ns - 1, out=o)
+		np.logical_and(v, o, out=v)
+		np.floor(x, out=y0)
+		np.subtract(x, y0, out=x)
+		np.clip(y0, 0, ns - 1, out=y0)
+		l[...] = y0
+		np.add(l, 1, out=u)
+		np.minimum(u, ns - 1, out=u)
+
+		# offset indices to the start of each angle in the flattened sinogram
+		offset = (np.arange(start, stop) * ns)[:, None, None]
+		l += offset
+		u += offset
+		np.logical_not(v, out=o)
+
+		for data, output in zip(flat, reconstruction):
+			np.take(data, l, out=y0)
+			np.take(data, u, out=y1)
+			np.subtract(y1, y0, out=y1)
+			np.multiply(y1, x, out=y1)
+			np.add(y0, y1, out=y0)
+			y0[o] = 0
+
+			# add this data to output, remembering to multiply by dtheta as well as sum
+			np.sum(y0, axis=0, out=partial)
+			partial *= math.pi / angles
+			output += partial
+
+		if report:
+			progress('back_project', stop, angles)
+
+def back_project_tiled(sinogram, skip=1, memory=2**28, chunk=16, out=None, filename=None, workers=None):
+
+	"""reconstruction = back_project_tiled(sinogram, skip, memory) gives the
+	same result as back_project(sinogram, skip, None, chunk), but works out
+	the image one square tile at a time, forming only the coordinates of
+	the pixels in each tile. The tile size is chosen so that the working
+	memory is at most about memory bytes, whatever the size of the image,
+	and every tile uses all of the angles, as the sinogram is much smaller
+	than the image.
+
+	The reconstruction is written to out if given, such as an np.memmap, or
+	otherwise to a new np.memmap stored in filename if given, so that the
+	image itself does not need to fit in memory. sinogram can also be a
+	stack of sinograms (slices x angles x samples), as for back_project.
+	Each tile is back-projected by workers threads, if given."""
+
+	# get input dimensions
+	ns = sinogram.shape[-1]
+	angles = sinogram.shape[-2]
+	n = int(math.floor((ns-1) // skip) + 1)
+	shape = sinogram.shape[:-2] + (n, n)
+	dtype = sinogram.dtype if sinogram.dtype.kind == 'f' else np.dtype(float)
+
+	if out is None:
+		if filename is None:
+			out = np.zeros(shape, dtype=dtype)
+		else:
+			out = np.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+	elif out.shape != shape:
+		raise ValueError('out has different size to the reconstruction')
+
+	# working memory for each pixel of a tile, for the buffers in
+	# back_project_chunked, which are split between any workers, and the tile
+	chunk = max(1, min(int(chunk), angles))
+	slices = int(np.prod(sinogram.shape[:-2], dtype=int))
+	itemsize = dtype.itemsize
+	pixel = chunk * (3 * itemsize + 2 * np.dtype(np.intp).itemsize + 2) + (slices + 1) * itemsize
+	side = max(1, min(n, math.isqrt(max(1, int(memory // pixel)))))
+
+	r = np.arange(0, ns, skip) - (ns/2) + 0.5
+	sinogram = np.ascontiguousarray(sinogram, dtype=dtype)
+	tiles = math.ceil(n / side) ** 2
+	done = 0
+
+	for r0 in range(0, n, side):
+		for c0 in range(0, n, side):
+			rows = r[r0:r0 + side]
+			columns = r[c0:c0 + side]
+			tile = np.zeros(sinogram.shape[:-2] + (len(rows), len(columns)), dtype=dtype)
+			back_project_chunked(sinogram, skip, chunk, tile, rows, columns, workers)
+
+			# ensure any data outside the reconstructed circle is set to invalid
+			tile[..., (rows[:, np.newaxis] ** 2 + columns ** 2) > (ns/2)**2] = -1
+			out[..., r0:r0 + len(rows), c0:c0 + len(columns)] = tile
+
+			done += 1
+			progress('back_project_tiled', done, tiles)
 
-	sys.stdout.write("\n")
+	if isinstance(out, np.memmap):
+		out.flush()
 
-	return reconstruction
\ No newline at end of file
+	return out
\ No newline at end of file
@@ -0,0 +1,224 @@
+import numpy as np
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import scipy
+from material import get_material
+from source import get_source
+from ct_phantom import *
+from ct_scan import *
+from ct_detect import *
+from ct_calibrate import *
+from ramp_filter import *
+from back_project import *
+from hu import *
+from create_dicom import *
+from xtreme import Xtreme, write_rsq
+from calibration import clear_calibrations
+
+# stages in the order of the scanning and reconstruction process
+STAGES = ['ct_phantom', 'ct_scan', 'ct_detect', 'ct_calibrate', 'ramp_filter', 'back_project', 'hu',
+	'fan_to_parallel', 'create_dicom']
+
+def measure(func, repeat=3):
+
+	""" result = measure(func, repeat) calls func() repeat times and returns
+	a dictionary with the shortest wall time 'time' and processor time 'cpu'
+	in seconds, and then calls it once more while tracing memory allocations
+	to find the peak memory allocated 'peak', in bytes. Anything func
+	writes to stdout is discarded."""
+
+	times = []
+	cpus = []
+	with contextlib.redirect_stdout(io.StringIO()):
+		for r in range(repeat):
+			start = time.perf_counter()
+			cpu = time.process_time()
+			func()
+			times.append(time.perf_counter() - start)
+			cpus.append(time.process_time() - cpu)
+
+		tracemalloc.start()
+		try:
+			func()
+			peak = tracemalloc.get_traced_memory()[1]
+		finally:
+			tracemalloc.stop()
+
+	return {'time': min(times), 'cpu': min(cpus), 'peak': peak}
+
+def benchmark_size(n, angles, stages=STAGES, repeat=3, directory=None):
+
+	""" results = benchmark_size(n, angles, stages, repeat) measures each of
+	the given stages for a phantom of size (n x n) scanned at the given
+	number of angles, and returns the measurements of each by name. Each
+	stage is given the output of the previous ones as its input.
+
+	ct_calibrate and hu share a calibration for each source, material and
+	size, so are measured with it already worked out, and also with 'cold'
+	measurements, which work it out again for every call."""
+
+	material = get_material()
+	source = get_source()
+	scale = 0.1 * 256 / n
+	photons = source.photon('100kVp, 3mm Al') * 10000 * scale ** 2
+	if directory is None:
+		directory = tempfile.gettempdir()
+
+	# the inputs of each stage, worked out once without being timed
+	with contextlib.redirect_stdout(io.StringIO()):
+		phantom = ct_phantom(material.name, n, 3)
+		scan = ct_scan(photons, material, phantom, scale, angles)
+		sinogram = ct_calibrate(photons, material, scan, scale)
+		filtered = ramp_filter(sinogram, scale)
+		reconstruction = back_project(filtered)
+		image = hu(photons, material, reconstruction, scale)
+	depth = np.random.default_rng(0).uniform(0, 2 * n * scale / len(material.coeffs), (len(material.coeffs), angles * n))
+
+	tasks = {
+		'ct_phantom': lambda: create_phantom.__wrapped__(tuple(material.name), n, 3),
+		'ct_scan': lambda: ct_scan(photons, material, phantom, scale, angles),
+		'ct_detect': lambda: ct_detect(photons, material.coeffs, depth),
+		'ct_calibrate': lambda: ct_calibrate(photons, material, scan, scale),
+		'ramp_filter': lambda: ramp_filter(sinogram, scale),
+		'back_project': lambda: back_project(filtered),
+		'hu': lambda: hu(photons, material, reconstruction, scale),
+		'create_dicom': lambda: create_dicom(image, os.path.join(directory, 'benchmark'), scale * 10),
+	}
+
+	# stages which use a shared calibration, timed again without it
+	cold = {
+		'ct_calibrate': lambda: (clear_calibrations(), ct_calibrate(photons, material, scan, scale)),
+		'hu': lambda: (clear_calibrations(), hu(photons, material, reconstruction, scale)),
+	}
+
+	results = {}
+	for stage in stages:
+		if stage == 'fan_to_parallel':
+			filename = os.path.join(directory, 'benchmark_%d.rsq' % n)
+			write_rsq(filename, n, scans=1)
+			x = Xtreme(filename)
+			Y, Ymin, Ymax = x.get_rsq_slice(0)
+			results[stage] = measure(lambda: x.fan_to_parallel(Y), repeat)
+			results[stage]['first'] = measure(lambda: Xtreme(filename).fan_to_parallel(Y), 1)['time']
+			os.remove(filename)
+		elif stage in tasks:
+			results[stage] = measure(tasks[stage], repeat)
+			if stage in cold:
+				results[stage]['cold'] = measure(cold[stage], repeat)
+
+	return results
+
+def fit_exponent(sizes, values):
+
+	""" k = fit_exponent(sizes, values) returns the exponent k of the power
+	law values = c * sizes^k which best fits the measurements, in the least
+	squares sense on a log-log scale, or None if there are too few of them"""
+
+	sizes = np.asarray(sizes, dtype=float)
+	values = np.asarray(values, dtype=float)
+	valid = values > 0
+	if np.count_nonzero(valid) < 2:
+		return None
+
+	return float(np.polyfit(np.log(sizes[valid]), np.log(values[valid]), 1)[0])
+
+def benchmark(sizes=(64, 128, 256, 512, 1024, 2048), angles=None, stages=STAGES, repeat=3, angle_size=256):
+
+	""" results = benchmark(sizes, angles, stages, repeat, angle_size) measures
+	each of the stages for phantoms of each size n, scanned at n angles, and
+	also for a phantom of size angle_size scanned at each of the numbers of
+	angles given in angles. The exponents of the time and memory against n,
+	and against the number of angles, are fitted to the measurements, and
+	everything is returned in a dictionary which can be saved as JSON."""
+
+	results = {'sizes': {}, 'angles': {}, 'exponents': {}, 'info': info()}
+
+	with tempfile.TemporaryDirectory() as directory:
+		for n in sizes:
+			print('Benchmarking n = %d' % n)
+			results['sizes'][str(n)] = benchmark_size(n, n, stages, repeat, directory)
+
+		# only some stages depend on the number of angles
+		angle_stages = [stage for stage in stages if stage in ['ct_scan', 'ct_calibrate', 'ramp_filter', 'back_project']]
+		for a in (angles or []):
+			print('Benchmarking angles = %d' % a)
+			results['angles'][str(a)] = benchmark_size(angle_size, a, angle_stages, repeat, directory)
+
+	for name, values in [('n', sizes), ('angles', angles or [])]:
+		key = 'sizes' if name == 'n' else 'angles'
+		for stage in stages:
+			points = [(v, results[key][str(v)][stage]) for v in values if stage in results[key][str(v)]]
+			if len(points) > 0:
+				exponents = results['exponents'].setdefault(stage, {})
+				exponents['time_' + name] = fit_exponent([p[0] for p in points], [p[1]['time'] for p in points])
+				exponents['peak_' + name] = fit_exponent([p[0] for p in points], [p[1]['peak'] for p in points])
+				if all('cold' in p[1] for p in points):
+					exponents['cold_time_' + name] = fit_exponent([p[0] for p in points], [p[1]['cold']['time'] for p in points])
+
+	return results
+
+def info():
+
+	"""returns a dictionary describing this commit and machine, so that
+	results can be compared"""
+
+	try:
+		commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+			cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+	except OSError:
+		commit = ''
+
+	return {'commit': commit, 'time': datetime.datetime.now().isoformat(), 'python': platform.python_version(),
+		'numpy': np.__version__, 'scipy': scipy.__version__, 'machine': platform.machine(),
+		'processor': platform.processor(), 'cpus': os.cpu_count()}
+
+def compare(old, new):
+
+	""" compare(old, new) prints the ratio of the times in the benchmark
+	results new to those in old, for each size and stage in both"""
+
+	for key in ['sizes', 'angles']:
+		for size in new[key]:
+			for stage, result in new[key][size].items():
+				if (size in old[key]) and (stage in old[key][size]):
+					print('%-7s %6s %-16s %10.4fs %10.4fs %6.2fx' % (key, size, stage,
+						old[key][size][stage]['time'], result['time'], old[key][size][stage]['time'] / result['time']))
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Time and memory benchmarks of each stage')
+	parser.add_argument('--sizes', type=int, nargs='+', default=[64, 128, 256, 512, 1024, 2048])
+	parser.add_argument('--angles', type=int, nargs='*', default=[64, 128, 256, 512, 1024])
+	parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+	parser.add_argument('--repeat', type=int, default=3)
+	parser.add_argument('--output', help='output JSON file, in results by default')
+	parser.add_argument('--compare', help='earlier output JSON file to compare with')
+	args = parser.parse_args()
+
+	results = benchmark(args.sizes, args.angles, args.stages, args.repeat)
+
+	output = args.output
+	if output is None:
+		commit = results['info']['commit'][:8] or 'unknown'
+		output = os.path.join('results', 'benchmark_' + commit + '_' + datetime.datetime.now().strftime('%Y%m%d_%H%M%S') + '.json')
+	os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+	with open(output, 'w') as f:
+		json.dump(results, f, indent=1)
+	print('Saved', output)
+
+	for stage, exponents in results['exponents'].items():
+		print('%-16s' % stage, ' '.join('%s %.2f' % (k, v) for k, v in exponents.items() if v is not None))
+
+	if args.compare:
+		with open(args.compare) as f:
+			compare(json.load(f), results)
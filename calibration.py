@@ -0,0 +1,107 @@
+import numpy as np
+import collections
+import math
+import warnings
+from attenuate import attenuate
+from ct_detect import ct_detect
+
+class Calibration(object):
+	def __init__(self, photons, material, scale, n):
+		"""Calibration holds the beam-hardening calibration for a CT scan
+		c = Calibration(photons, material, scale, n) works out, for the source
+		energy distribution photons, the material structure, the pixel size
+		scale in cm, and n samples per angle:
+
+		'air_total' - total detections through air for the fixed distance of
+		              twice the side length between source and detector
+		'depths' - water depths, in cm, used for beam-hardening correction,
+		           up to 100 cm or the diagonal of the phantom if longer
+		'p_w' - normalised attenuation measured through each of those depths
+		'mu_water' - linear attenuation coefficient of water after calibration
+
+		Use get_calibration to share instances with the same inputs."""
+
+		self.scale = scale
+		self.n = n
+
+		# retrieve air coefficients, and work out detection for just air of
+		# twice the side length (has to be the same as in ct_scan.py)
+		air = material.name.index('Air')
+		air_coeff = material.coeffs[air]
+		depth = 2 * n * scale # for the fixed distance between source and detector
+		source_total = attenuate(photons, air_coeff, depth)
+		self.air_total = np.sum(source_total)
+
+		# beam hardening correction table, through increasing depths of water,
+		# at least as long as the longest ray through the phantom
+		self.depths = np.arange(0, max(100, math.ceil(n * scale * math.sqrt(2)) + 1), 0.1)
+		water_idx = material.name.index('Water')
+		water_coeff = material.coeffs[water_idx]
+		I_tot = ct_detect(photons, water_coeff, self.depths)
+		self.p_w = -np.log(I_tot / self.air_total)
+
+		# put water through the same calibration process as the normal CT data
+		water_energy = ct_detect(photons, water_coeff, depth)
+		self.mu_water = self.apply(water_energy)[0] / depth
+
+	def apply(self, sinogram, out=None, chunk=2**16):
+		"""Given CT detections in sinogram (of any shape), this returns the
+		linearised attenuation, with the same type as sinogram if it is
+		floating point, or in out if given, which can be sinogram itself.
+		chunk samples are worked on at a time, so that no full size double
+		precision copies are made.
+
+		Detections which are more attenuated than the deepest water in the
+		table are clamped to that depth, with a warning, rather than being
+		extrapolated."""
+
+		sinogram = np.asarray(sinogram)
+		if out is None:
+			out = np.empty(sinogram.shape, dtype=sinogram.dtype if sinogram.dtype.kind == 'f' else float)
+		if (out.shape != sinogram.shape) or not out.flags.c_contiguous:
+			raise ValueError('out must be a contiguous array of the same size as sinogram')
+		flat = sinogram.reshape(-1)
+		result = out.reshape(-1)
+		clamped = 0
+
+		for start in range(0, flat.size, chunk):
+			block = flat[start:start + chunk]
+
+			# normalise the energy to total attenuation coefficient
+			block = -np.log(block / self.air_total)
+
+			# beam hardening correction
+			clamped += np.count_nonzero(block > self.p_w[-1])
+			result[start:start + chunk] = np.interp(block, self.p_w, self.depths)
+
+		if clamped > 0:
+			warnings.warn('%d detections are beyond the calibration table, and have been clamped to %g cm of water'
+				% (clamped, self.depths[-1]))
+
+		return out
+
+
+_calibrations = collections.OrderedDict()
+
+def get_calibration(photons, material, scale, n, maxsize=16):
+	"""c = get_calibration(photons, material, scale, n) returns a shared
+	Calibration for the given inputs, keeping up to maxsize of the most
+	recently used ones so that the calibration is only worked out once"""
+
+	photons = np.asarray(photons, dtype=float)
+	key = (photons.tobytes(), tuple(material.name), material.coeffs.tobytes(), float(scale), int(n))
+
+	if key in _calibrations:
+		_calibrations.move_to_end(key)
+	else:
+		_calibrations[key] = Calibration(photons, material, scale, n)
+		while len(_calibrations) > maxsize:
+			_calibrations.popitem(last=False)
+
+	return _calibrations[key]
+
+def clear_calibrations():
+	"""clear_calibrations() forgets all of the shared calibrations, so that
+	the next get_calibration works each one out again"""
+
+	_calibrations.clear()
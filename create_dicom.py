@@ -1,66 +1,37 @@
 import datetime
+import threading
+import queue
 import pydicom
 from pydicom.dataset import Dataset, FileDataset
+from pydicom.sequence import Sequence
 import numpy as np
 import os
+import glob
+import warnings
 
+# decodes the frames of a multi-frame file one at a time, from pydicom 3
+try:
+	from pydicom.pixels import iter_pixels
+except ImportError:
+	iter_pixels = None
+import concurrent.futures
 
-def create_dicom(x, filename, sp, sz=None, f=1, study_uid=None, series_uid=None, frame_uid=None, time=datetime.datetime.now(), storage_directory=None):
 
-	""" Create DICOM format output file from data
-
-	create_dicom(x, filename, sp) creates a new DICOM file with a
-	name `filename_0001.dcm' and containing data from x. The pixel scale is
-	given by sp which is in mm.
-
-	create_dicom(x, filename, sp, sz, f) creates a new DICOM file with a
-	name formed from the given filename and the frame number f, and
-	containing data from x. The pixel scale is given by sp, and the frame
-	spacing is given by sz, both of which are in mm.
-
-	create_dicom(x, filename, sp, sz, f, study_uid, series_uid, time)
-	uses the DICOM UIDs study_uid and series_uid, and also the
-	datetime, for the file. This is useful if you want to write several
-	frames in the same DICOM series. The UIDs can be generated
-	using the DICOMUID function. The time can be generated using datetime.datetime.now().
-
-	optional storage_directory parameter can set the file's storage directory path
-	"""
-
-	# check for inputs
-	if sz is None:
-		sz = sp
-
-	if study_uid is None:
-		study_uid = pydicom.uid.generate_uid()
+def dicom_template(filename, sp, sz, study_uid, series_uid, frame_uid, time):
 
-	if series_uid is None:
-		series_uid = pydicom.uid.generate_uid()
-
-	if frame_uid is None:
-		frame_uid = pydicom.uid.generate_uid()
-
-
-	# get data with the appropriate limits
-	x = x + 1024
-	x = np.clip(x, 0, None)
-	x = np.clip(x, None, 4096)
-
-	# Initial write to create DICOM file with default settings
-	full_filename = filename + '_' + str(f).zfill(4) + '.dcm'
-	full_file = full_filename
-
-	#add storage directory if needed
-	if storage_directory is not None:
-		full_filename = os.path.join(storage_directory, full_filename)
+	""" ds = dicom_template(filename, sp, sz, study_uid, series_uid, frame_uid, time)
+	creates a FileDataset containing every tag which is the same for all the
+	frames of a series, as for create_dicom. The tags for each frame are then
+	set using dicom_frame."""
 
 	series_date = time.strftime('%Y%m%d')
 	series_time = time.strftime('%H%M%S.%f')
 	nowtime = datetime.datetime.now()
 
 	# necessary tags
-	ds = FileDataset(full_file, {}, file_meta=Dataset(), preamble=b"\0"*128)
+	ds = FileDataset(filename, {}, file_meta=Dataset(), preamble=b"\0"*128)
 	ds.file_meta.TransferSyntaxUID = '1.2.840.10008.1.2'
+	ds.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
 	ds.Modality = 'CT'
 	ds.ContentDate = nowtime.strftime('%Y%m%d')
 	ds.ContentTime = nowtime.strftime('%H%M%S.%f')
@@ -69,7 +40,6 @@ def create_dicom(x, filename, sp, sz=None, f=1, study_uid=None, series_uid=None,
 	ds.StudyInstanceUID =  study_uid
 	ds.SeriesInstanceUID = series_uid
 	ds.SOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
-	ds.SOPInstanceUID = pydicom.uid.generate_uid()
 	ds.FrameOfReferenceUID = frame_uid
 	ds.StudyDescription = 'GG2 Study ' + study_uid[56:]
 	ds.SeriesDescription = 'GG2 Series ' + series_uid[56:]
@@ -85,12 +55,10 @@ def create_dicom(x, filename, sp, sz=None, f=1, study_uid=None, series_uid=None,
 	ds.RescaleType = 'HU'
 	ds.WindowWidth = '2000'
 	ds.WindowCenter = '0'
-	ds.ImagePositionPatient = [0.000, 0.000, round(float(f * sz), 8)]
 	ds.ImageOrientationPatient = [1.000, 0.000, 0.000, 0.000, 1.000, 0.000]
 	ds.SpacingBetweenSlices = str(round(sz, 8))
 	ds.SliceThickness = str(round(sz, 8))
 	ds.GantryDetectorTilt = '0'
-	ds.SliceLocation = str(round(f * sz, 8))
 	ds.PixelSpacing = [sp, sp]
 
 	## These are the necessary imaging components of the FileDataset object.
@@ -100,18 +68,308 @@ def create_dicom(x, filename, sp, sz=None, f=1, study_uid=None, series_uid=None,
 	ds.HighBit = 15
 	ds.BitsStored = 16
 	ds.BitsAllocated = 16
+
+	return ds
+
+def dicom_frame(ds, x, f, sz):
+
+	""" dicom_frame(ds, x, f, sz) sets the tags of the dataset ds for frame
+	number f with frame spacing sz, and containing the uint16 pixel values x
+	from dicom_pixels. A new SOP instance UID is used each time."""
+
+	ds.SOPInstanceUID = pydicom.uid.generate_uid()
+	ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+	ds.InstanceNumber = f
+	ds.ImagePositionPatient = [0.000, 0.000, round(float(f * sz), 8)]
+	ds.SliceLocation = str(round(f * sz, 8))
 	ds.Columns = x.shape[1]
 	ds.Rows = x.shape[0]
+	ds.PixelData = x.tobytes()
+
+def dicom_pixels(x, out=None, scratch=None):
+
+	""" y = dicom_pixels(x, out, scratch) converts the image x, in HU, to the
+	uint16 values which are stored in the DICOM files, in the range 0 to 4096
+	with an offset of 1024. If given, the result is written to out, and
+	scratch is a float array of the same size used for the working, so that
+	no new arrays are needed."""
+
+	if out is None:
+		out = np.empty(x.shape, dtype=np.uint16)
+
+	# get data with the appropriate limits
+	scratch = np.add(x, 1024, out=scratch)
+	np.clip(scratch, 0, 4096, out=scratch)
+	np.copyto(out, scratch, casting='unsafe')
+
+	return out
+
+def create_dicom(x, filename, sp, sz=None, f=1, study_uid=None, series_uid=None, frame_uid=None, time=None, storage_directory=None):
+
+	""" Create DICOM format output file from data
+
+	create_dicom(x, filename, sp) creates a new DICOM file with a
+	name `filename_0001.dcm' and containing data from x. The pixel scale is
+	given by sp which is in mm.
+
+	create_dicom(x, filename, sp, sz, f) creates a new DICOM file with a
+	name formed from the given filename and the frame number f, and
+	containing data from x. The pixel scale is given by sp, and the frame
+	spacing is given by sz, both of which are in mm.
+
+	create_dicom(x, filename, sp, sz, f, study_uid, series_uid, time)
+	uses the DICOM UIDs study_uid and series_uid, and also the
+	datetime, for the file. This is useful if you want to write several
+	frames in the same DICOM series. The UIDs can be generated
+	using the DICOMUID function. The time defaults to datetime.datetime.now().
+
+	optional storage_directory parameter can set the file's storage directory path
+
+	To write a whole series, DicomSeries is much faster.
+	"""
+
+	# check for inputs
+	if sz is None:
+		sz = sp
+
+	if study_uid is None:
+		study_uid = pydicom.uid.generate_uid()
 
-	if x.dtype != np.uint16:
-		x = x.astype(np.uint16)
+	if series_uid is None:
+		series_uid = pydicom.uid.generate_uid()
 
-	ds.PixelData = x.tostring()
+	if frame_uid is None:
+		frame_uid = pydicom.uid.generate_uid()
+
+	if time is None:
+		time = datetime.datetime.now()
+
+	# Initial write to create DICOM file with default settings
+	full_filename = filename + '_' + str(f).zfill(4) + '.dcm'
+	full_file = full_filename
+
+	#add storage directory if needed
+	if storage_directory is not None:
+		full_filename = os.path.join(storage_directory, full_filename)
+
+	ds = dicom_template(full_file, sp, sz, study_uid, series_uid, frame_uid, time)
+	dicom_frame(ds, dicom_pixels(x), f, sz)
 
 	# write final file with this metadata
 	ds.save_as(full_filename, write_like_original=False)
 
 
+class DicomSeries(object):
+	def __init__(self, filename, sp, sz=None, study_uid=None, series_uid=None, frame_uid=None, time=None, storage_directory=None, multiframe=False, pending=4):
+
+		""" Write a series of frames to DICOM files
+
+		series = DicomSeries(filename, sp, sz) writes each frame given to
+		series.write(x) to a DICOM file, named and tagged in the same way as
+		create_dicom for frames 1, 2, 3, ... The inputs are as for
+		create_dicom, and the same UIDs and time are used for every frame.
+
+		The header is only created once, and only the tags which change are
+		set for each frame. The files are written by a background thread,
+		with up to pending frames waiting to be written, so that the next
+		frame can be worked out at the same time. series.close() waits for
+		all the files to be written, and the series can also be used in a
+		with statement.
+
+		series = DicomSeries(..., multiframe=True) instead writes all of the
+		frames to a single Enhanced CT multi-frame file `filename.dcm' when
+		the series is closed. Every frame is kept in memory until then, as
+		16 bit pixels, so the memory used grows with the number of frames.
+
+		If the with statement ends with an exception, the frames which have
+		been given so far are still written, except in a multi-frame file,
+		which is only written once it is complete, and any error writing
+		them is only given as a warning, so that the original exception is
+		the one raised."""
+
+		# check for inputs
+		if sz is None:
+			sz = sp
+
+		if study_uid is None:
+			study_uid = pydicom.uid.generate_uid()
+
+		if series_uid is None:
+			series_uid = pydicom.uid.generate_uid()
+
+		if frame_uid is None:
+			frame_uid = pydicom.uid.generate_uid()
+
+		if time is None:
+			time = datetime.datetime.now()
+
+		self.filename = filename
+		self.sz = sz
+		self.storage_directory = storage_directory
+		self.multiframe = multiframe
+		self.frames = []
+		self.f = 1
+		self._ds = dicom_template(filename, sp, sz, study_uid, series_uid, frame_uid, time)
+		self._scratch = None
+		self._error = None
+		self._closed = False
+
+		# frames waiting to be written, and pixel buffers which can be reused
+		self._queue = queue.Queue(max(1, pending))
+		self._free = queue.Queue()
+		self._thread = None
+		if not multiframe:
+			self._thread = threading.Thread(target=self._run, daemon=True)
+			self._thread.start()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		if type is None:
+			self.close()
+			return
+
+		# keep the original exception, only warning about any error writing
+		# the frames before it
+		self.frames = []
+		try:
+			self.close()
+		except Exception as e:
+			warnings.warn('error writing DICOM series %s: %r' % (self.filename, e))
+
+	def write(self, x, f=None):
+
+		""" series.write(x, f) writes the image x, in HU, as frame f, which
+		defaults to the frame after the last one written. A ValueError is
+		raised if the series has been closed."""
+
+		if self._closed:
+			raise ValueError('series is closed')
+
+		if self._error is not None:
+			raise self._error
+
+		if f is None:
+			f = self.f
+		self.f = f + 1
+
+		if (self._scratch is None) or (self._scratch.shape != x.shape):
+			self._scratch = np.empty(x.shape)
+
+		if self.multiframe:
+			self.frames.append((f, dicom_pixels(x, scratch=self._scratch)))
+			return
+
+		# reuse the pixels of a frame which has already been written
+		try:
+			pixels = self._free.get_nowait()
+		except queue.Empty:
+			pixels = None
+		if (pixels is None) or (pixels.shape != x.shape):
+			pixels = np.empty(x.shape, dtype=np.uint16)
+
+		self._queue.put((f, dicom_pixels(x, pixels, self._scratch)))
+
+	def _run(self):
+
+		# write each frame in turn, until None is received
+		while True:
+			item = self._queue.get()
+			if item is None:
+				return
+			if self._error is not None:
+				continue
+			f, pixels = item
+			try:
+				full_filename = self.filename + '_' + str(f).zfill(4) + '.dcm'
+				self._ds.filename = full_filename
+				dicom_frame(self._ds, pixels, f, self.sz)
+				if self.storage_directory is not None:
+					full_filename = os.path.join(self.storage_directory, full_filename)
+				self._ds.save_as(full_filename, write_like_original=False)
+			except Exception as e:
+				self._error = e
+			self._free.put(pixels)
+
+	def close(self):
+
+		""" series.close() finishes writing the series, after which no more
+		frames can be written"""
+
+		self._closed = True
+		if self._thread is not None:
+			self._queue.put(None)
+			self._thread.join()
+			self._thread = None
+		elif self.multiframe and (len(self.frames) > 0):
+			self._write_multiframe()
+			self.frames = []
+
+		if self._error is not None:
+			raise self._error
+
+	def _write_multiframe(self):
+
+		ds = self._ds
+		full_filename = self.filename + '.dcm'
+		ds.filename = full_filename
+		if self.storage_directory is not None:
+			full_filename = os.path.join(self.storage_directory, full_filename)
+
+		# Enhanced CT image, with the tags which are the same for every frame
+		# in the shared functional groups
+		ds.SOPClassUID = '1.2.840.10008.5.1.4.1.1.2.1'
+		ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+		ds.SOPInstanceUID = pydicom.uid.generate_uid()
+		ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+		ds.ImageType = ['DERIVED', 'PRIMARY', 'AXIAL', 'NONE']
+		ds.InstanceNumber = 1
+
+		measures = Dataset()
+		measures.PixelSpacing = ds.PixelSpacing
+		measures.SliceThickness = ds.SliceThickness
+		measures.SpacingBetweenSlices = ds.SpacingBetweenSlices
+		orientation = Dataset()
+		orientation.ImageOrientationPatient = ds.ImageOrientationPatient
+		transformation = Dataset()
+		transformation.RescaleIntercept = ds.RescaleIntercept
+		transformation.RescaleSlope = ds.RescaleSlope
+		transformation.RescaleType = ds.RescaleType
+		window = Dataset()
+		window.WindowCenter = ds.WindowCenter
+		window.WindowWidth = ds.WindowWidth
+		shared = Dataset()
+		shared.PixelMeasuresSequence = Sequence([measures])
+		shared.PlaneOrientationSequence = Sequence([orientation])
+		shared.PixelValueTransformationSequence = Sequence([transformation])
+		shared.FrameVOILUTSequence = Sequence([window])
+		ds.SharedFunctionalGroupsSequence = Sequence([shared])
+		for keyword in ['PixelSpacing', 'SliceThickness', 'SpacingBetweenSlices', 'ImageOrientationPatient',
+				'RescaleIntercept', 'RescaleSlope', 'RescaleType', 'WindowCenter', 'WindowWidth']:
+			delattr(ds, keyword)
+
+		# and the position of each frame
+		groups = []
+		for f, pixels in self.frames:
+			position = Dataset()
+			position.ImagePositionPatient = [0.000, 0.000, round(float(f * self.sz), 8)]
+			content = Dataset()
+			content.InStackPositionNumber = f
+			group = Dataset()
+			group.PlanePositionSequence = Sequence([position])
+			group.FrameContentSequence = Sequence([content])
+			groups.append(group)
+		ds.PerFrameFunctionalGroupsSequence = Sequence(groups)
+
+		ds.NumberOfFrames = len(self.frames)
+		ds.Rows = self.frames[0][1].shape[0]
+		ds.Columns = self.frames[0][1].shape[1]
+		ds.PixelData = b''.join([pixels.tobytes() for f, pixels in self.frames])
+
+		ds.save_as(full_filename, write_like_original=False)
+
+
 def read_dicom(filename):
 
 	""" Read DICOM format input file to data
@@ -126,3 +384,124 @@ def read_dicom(filename):
     
 	return x, sp
 
+
+def read_dicom_series(filenames, workers=None, memmap=None):
+
+	""" Read a DICOM series into a volume
+
+	[x, sp, sz] = read_dicom_series(filenames) reads all of the DICOM files
+	in the list filenames, or which match the pattern filenames (such as
+	'name_*.dcm'), into the (int16) volume x, of size (slices x rows x
+	columns). The slices are sorted by their position along z, from
+	ImagePositionPatient or SliceLocation. The pixel scale is returned in sp
+	and the spacing between slices in sz, both of which are in mm. The
+	pixels are converted to HU with RescaleSlope and RescaleIntercept, and
+	rounded if the slope is not 1.
+
+	A single Enhanced CT multi-frame file, as written by DicomSeries, is
+	also read into the same volume.
+
+	The files are read by workers threads at once, and each slice is
+	decoded straight into x. If memmap is given, x is a numpy memmap
+	stored in that file, so the volume does not need to fit in memory."""
+
+	if isinstance(filenames, str):
+		filenames = sorted(glob.glob(filenames))
+	if len(filenames) == 0:
+		raise FileNotFoundError('no DICOM files to read')
+
+	with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+
+		# read the headers first, to put the slices in order
+		headers = list(pool.map(lambda f: pydicom.filereader.dcmread(f, stop_before_pixels=True), filenames))
+
+		if (len(headers) == 1) and (int(headers[0].get('NumberOfFrames', 1)) > 1):
+			return read_dicom_frames(filenames[0], memmap)
+
+		positions = np.array([dicom_position(ds) for ds in headers])
+		order = np.argsort(positions, kind='stable')
+		first = headers[order[0]]
+		shape = (len(filenames), int(first.Rows), int(first.Columns))
+		if memmap is None:
+			x = np.empty(shape, dtype=np.int16)
+		else:
+			x = np.memmap(memmap, dtype=np.int16, mode='w+', shape=shape)
+
+		def decode(i):
+			ds = pydicom.filereader.dcmread(filenames[order[i]])
+			dicom_rescale(ds.pixel_array, ds.get('RescaleSlope', 1), ds.get('RescaleIntercept', 0), x[i])
+
+		for _ in pool.map(decode, range(len(order))):
+			pass
+
+	return x, first.PixelSpacing[0], dicom_spacing(positions[order], first)
+
+def read_dicom_frames(filename, memmap=None):
+
+	""" [x, sp, sz] = read_dicom_frames(filename, memmap) reads an Enhanced
+	CT multi-frame file into the volume x, in the same way as
+	read_dicom_series. With pydicom 3 or later, the frames are decoded one
+	at a time straight into x, so that with memmap the volume does not need
+	to fit in memory, but earlier versions decode every frame at once."""
+
+	ds = pydicom.filereader.dcmread(filename, stop_before_pixels=True)
+	shared = ds.SharedFunctionalGroupsSequence[0]
+	transformation = shared.PixelValueTransformationSequence[0]
+	slope = transformation.get('RescaleSlope', 1)
+	intercept = transformation.get('RescaleIntercept', 0)
+	positions = np.array([float(group.PlanePositionSequence[0].ImagePositionPatient[2])
+		for group in ds.PerFrameFunctionalGroupsSequence])
+	order = np.argsort(positions, kind='stable')
+
+	shape = (len(positions), int(ds.Rows), int(ds.Columns))
+	if memmap is None:
+		x = np.empty(shape, dtype=np.int16)
+	else:
+		x = np.memmap(memmap, dtype=np.int16, mode='w+', shape=shape)
+
+	# the slice of x which each frame goes in
+	rank = np.empty(len(order), dtype=int)
+	rank[order] = np.arange(len(order))
+	if iter_pixels is not None:
+		frames = iter_pixels(filename)
+	else:
+		frames = pydicom.filereader.dcmread(filename).pixel_array.reshape(shape)
+	for i, pixels in enumerate(frames):
+		dicom_rescale(pixels, slope, intercept, x[rank[i]])
+
+	measures = shared.PixelMeasuresSequence[0]
+	return x, measures.PixelSpacing[0], dicom_spacing(positions[order], measures)
+
+def dicom_rescale(pixels, slope, intercept, out):
+
+	"""dicom_rescale(pixels, slope, intercept, out) writes the stored pixels
+	of a DICOM frame to out in HU, using the rescale slope and intercept"""
+
+	slope = float(slope)
+	intercept = float(intercept)
+	if slope == 1:
+		np.add(pixels, intercept, out=out, casting='unsafe')
+	else:
+		out[...] = np.round(pixels * slope + intercept)
+
+def dicom_position(ds):
+
+	"""z = dicom_position(ds) returns the position along z of the slice in
+	the dataset ds"""
+
+	if 'ImagePositionPatient' in ds:
+		return float(ds.ImagePositionPatient[2])
+	if 'SliceLocation' in ds:
+		return float(ds.SliceLocation)
+	return float(ds.get('InstanceNumber', 0))
+
+def dicom_spacing(positions, ds):
+
+	"""sz = dicom_spacing(positions, ds) returns the spacing between slices
+	at the sorted positions, or from the tags in ds for a single slice"""
+
+	if len(positions) > 1:
+		return float(np.median(np.diff(positions)))
+	if 'SpacingBetweenSlices' in ds:
+		return float(ds.SpacingBetweenSlices)
+	return float(ds.get('SliceThickness', 0))
@@ -1,7 +1,7 @@
 import numpy as np
-from attenuate import attenuate
+from ct_noise import ct_noise
 
-def ct_detect(p, coeffs, depth, mas=10000):
+def ct_detect(p, coeffs, depth, mas=10000, chunk=2**20, rng=None, electronic=0, realizations=None, dtype=float, out=None):
 
 	"""ct_detect returns detector photons for given material depths.
 	y = ct_detect(p, coeffs, depth, mas) takes a source energy
@@ -10,8 +10,28 @@ def ct_detect(p, coeffs, depth, mas=10000):
 	in depth (materials, samples) and returns the detections at each sample
 	in y (samples).
 
-	mas defines the current-time-product which affects the noise distribution
-	for the linear attenuation"""
+	mas is not used. p must already be the number of photons for the
+	current-time product, such as photons * mas * scale ** 2 as in
+	scan_and_reconstruct, so the expected detections, and so the noise, are
+	already in photons. mas is only kept so that existing calls still work.
+
+	y = ct_detect(p, coeffs, depth, mas, chunk, rng, electronic) adds
+	Poisson quantum noise, and Gaussian electronic noise with standard
+	deviation electronic, drawn using rng, which is a numpy random Generator
+	or a seed. Without rng, the detections are noiseless. If realizations is
+	given, that many independent noise realizations of the same expected
+	detections are returned in y (realizations x samples). See ct_noise.
+
+	The detections are worked out, and returned, with type dtype, such as
+	np.float32 to halve the memory used, or in out (samples), if given.
+	out cannot be given with realizations, as y is then larger than out.
+	In single precision, the detections are within about 1e-6 of those in
+	double precision, relative to each detection.
+
+	The total attenuation at each energy is found with a single contraction
+	over materials, energies where p is zero are skipped, and samples are
+	worked on in blocks of at most chunk (energies x samples) elements, so
+	memory use is bounded for very wide inputs."""
 
 	# check p for number of energies
 	if type(p) != np.ndarray:
@@ -45,21 +65,35 @@ def ct_detect(p, coeffs, depth, mas=10000):
 		raise ValueError('input depth has different number of materials to input coeffs')
 	samples = depth.shape[1]
 
-	# extend source photon array so it covers all samples
-	detector_photons = np.zeros([energies, samples])
-	for e in range(energies):
-		detector_photons[e] = p[e]
+	# only energies which have source photons contribute to the detections
+	if out is not None:
+		if realizations is not None:
+			raise ValueError('out cannot be given with realizations')
+		dtype = out.dtype
+	active = np.flatnonzero(p)
+	p = p[active].astype(dtype)
+	coeffs = coeffs[:, active].T.astype(dtype)
 
-	# calculate array of residual mev x samples for each material in turn
-	for m in range(materials):
-		detector_photons = attenuate(detector_photons, coeffs[m], depth[m])
-
-	# sum this over energies
-	detector_photons = np.sum(detector_photons, axis=0)
+	# calculate the total attenuation (energies x samples) over all materials
+	# with one contraction, then the residual photons summed over energies
+	detector_photons = np.zeros(samples, dtype=dtype) if out is None else out
+	step = max(1, chunk // max(1, len(active)))
+	for start in range(0, samples, step):
+		stop = min(start + step, samples)
+		attenuation = coeffs @ depth[:, start:stop].astype(dtype, copy=False)
+		np.negative(attenuation, out=attenuation)
+		np.exp(attenuation, out=attenuation)
+		np.matmul(p, attenuation, out=detector_photons[start:stop])
 
 	# model noise
+	if rng is not None:
+		noisy = ct_noise(detector_photons, rng, electronic, realizations)
+		if realizations is None:
+			detector_photons[...] = noisy
+		else:
+			detector_photons = noisy.astype(dtype, copy=False)
 
 	# minimum detection is one photon
-	detector_photons = np.clip(detector_photons, 1, None)
+	np.clip(detector_photons, 1, None, out=detector_photons)
 
 	return detector_photons
\ No newline at end of file
@@ -0,0 +1,36 @@
+import numpy as np
+
+def ct_noise(counts, rng=None, electronic=0, realizations=None, chunk=2**22):
+
+	"""ct_noise adds detector noise to expected detections
+	y = ct_noise(counts, rng) takes the expected (noiseless) number of
+	photons detected at each sample in counts, of any shape, and returns
+	detections y of the same shape, drawn from a Poisson distribution to
+	model the quantum noise. rng is the numpy random Generator used for the
+	draws, or a seed for a new one, so that results can be repeated.
+
+	y = ct_noise(counts, rng, electronic) also adds Gaussian electronic noise,
+	with a standard deviation of electronic photons.
+
+	y = ct_noise(counts, rng, electronic, realizations) draws that many
+	independent realizations of the noise at once, from the same expected
+	counts, and returns them in y (realizations x counts.shape). They are
+	drawn in blocks of at most chunk samples, so that the temporary arrays
+	used for the draws are of bounded size."""
+
+	rng = np.random.default_rng(rng)
+	counts = np.asarray(counts, dtype=float)
+
+	if realizations is None:
+		y = ct_noise(counts, rng, electronic, 1, chunk)
+		return y[0]
+
+	y = np.empty((realizations,) + counts.shape)
+	step = max(1, chunk // max(1, counts.size))
+	for start in range(0, realizations, step):
+		stop = min(start + step, realizations)
+		y[start:stop] = rng.poisson(counts, (stop - start,) + counts.shape)
+		if electronic > 0:
+			y[start:stop] += rng.normal(0, electronic, (stop - start,) + counts.shape)
+
+	return y
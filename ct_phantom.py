@@ -1,9 +1,12 @@
 import numpy as np
-import numpy.matlib
+import functools
 import math
 
 def phantom(ellipses, n):
-	"""generates an artificial phantom given ellipse parameters and size n"""
+	"""generates an artificial phantom given ellipse parameters and size n
+
+	Each ellipse is only evaluated within its bounding box, which gives the
+	same result as evaluating it over the whole image"""
 
 	#convert to numpy array
 	ellipses = np.array(ellipses)
@@ -14,8 +17,8 @@ def phantom(ellipses, n):
 
 	phantom_instance = np.zeros((n, n))
 
-	xax = np.linspace(-1.0, 1.0, n, endpoint=True)
-	xg = np.matlib.repmat(xax, n, 1) # x coordinates, the y coordinates are rot90(xg)
+	xax = np.linspace(-1.0, 1.0, n, endpoint=True) # x coordinates of each column
+	yax = xax[::-1]                                 # y coordinates of each row
 
 	# ellipse = [amplitude, a, b, x0, y0, phi]
 	for ellipse in ellipses:
@@ -25,18 +28,73 @@ def phantom(ellipses, n):
 		x0 = ellipse[3]          # x offset
 		y0 = ellipse[4]          # y offset
 		a = ellipse[0]           # Amplitude change for this ellipse
-		x_center = xg - x0                # Center the ellipse
-		y_center = np.rot90(xg) - y0
 		cosp = math.cos(phi)
 		sinp = math.sin(phi)
+
+		# bounding box of the rotated ellipse, with an extra pixel either side
+		xext = math.sqrt(asq * cosp ** 2 + bsq * sinp ** 2)
+		yext = math.sqrt(asq * sinp ** 2 + bsq * cosp ** 2)
+		c0 = max(np.searchsorted(xax, x0 - xext) - 1, 0)
+		c1 = min(np.searchsorted(xax, x0 + xext, side='right') + 1, n)
+		r0 = n - min(np.searchsorted(xax, y0 + yext, side='right') + 1, n)
+		r1 = n - max(np.searchsorted(xax, y0 - yext) - 1, 0)
+		if (c0 >= c1) or (r0 >= r1):
+			continue
+
+		x_center = xax[np.newaxis, c0:c1] - x0      # Center the ellipse
+		y_center = yax[r0:r1, np.newaxis] - y0
 		values = (((x_center * cosp + y_center * sinp) ** 2) / asq + ((y_center *cosp - x_center * sinp) ** 2) / bsq) # normalised ellipse equation
 
-		for index, element in np.ndenumerate(values):
-				if element <= 1: # inside the ellipse
-					phantom_instance[index] = phantom_instance[index] + a
+		box = phantom_instance[r0:r1, c0:c1]
+		box[values <= 1] += a # inside the ellipse
 
 	return phantom_instance
 	
+def phantom3d(ellipsoids, n, slices):
+	"""generates an artificial volume phantom (slices x n x n) given
+	ellipsoid parameters, size n and number of slices
+
+	ellipsoid = [amplitude, a, b, c, x0, y0, z0, phi], where c and z0 are the
+	half-length and centre along z, which runs from -1 to 1 over the slices,
+	and phi is the rotation about z. Each slice is the phantom of the ellipse
+	cross-sections of the ellipsoids at that z."""
+
+	#convert to numpy array
+	ellipsoids = np.array(ellipsoids, dtype=float)
+
+	#handle both single ellipsoid and arrays of ellipsoids
+	if len(ellipsoids.shape) == 1:
+		ellipsoids = np.array([ellipsoids])
+
+	volume = np.zeros((slices, n, n))
+	zax = np.linspace(-1.0, 1.0, slices, endpoint=True)
+
+	for z, image in zip(zax, volume):
+
+		# the cross-section of each ellipsoid which meets this slice is an
+		# ellipse, with axes scaled by the same amount
+		r = 1 - ((z - ellipsoids[:, 6]) / ellipsoids[:, 3]) ** 2
+		inside = r > 0
+		if not np.any(inside):
+			continue
+		ellipses = ellipsoids[inside][:, [0, 1, 2, 4, 5, 7]]
+		ellipses[:, 1:3] *= np.sqrt(r[inside])[:, np.newaxis]
+		image += phantom(ellipses, n)
+
+	return volume
+
+def ct_phantom3d(names, n, slices, type, metal=None):
+
+	""" x = ct_phantom3d(names, n, slices, type, metal) creates a CT volume
+	phantom in x of size (slices x n x n), by stacking the phantom of the
+	same type from ct_phantom for every slice. See ct_phantom for the
+	phantom types, and the meaning of names and metal. x has the same
+	unsigned integer type as from ct_phantom, usually uint8."""
+
+	x = ct_phantom(names, n, type, metal)
+
+	return np.repeat(x[np.newaxis], slices, axis=0)
+
 def ct_phantom(names, n, type, metal=None):
 
 	""" ct_phantom create phantom for CT scanning
@@ -61,7 +119,24 @@ def ct_phantom(names, n, type, metal=None):
 
 		The output x has data values which correspond to indices in the names
 		array, which must also contain 'Air', 'Adipose', 'Soft Tissue' and 'Bone'.
-	"""  
+		It is of the smallest unsigned integer type which can hold them, which
+		is uint8 unless there are more than 256 names. Arithmetic on x is
+		also done in that type, and can wrap around, so convert it first
+		with x.astype(float) to do anything but index with it, such as
+		subtracting or scaling phantoms.
+
+		Phantoms are cached by (names, n, type, metal), so asking for the same
+		phantom again returns a copy of the one already generated.
+	"""
+
+	return create_phantom(tuple(names), n, type, metal).copy()
+
+@functools.lru_cache(maxsize=16)
+def create_phantom(names, n, type, metal=None):
+
+	""" x = create_phantom(names, n, type, metal) creates the phantom for
+	ct_phantom, where names is a tuple. The result is cached and shared, so
+	it must not be modified"""
 
 	# Get material locations
 	air = names.index('Air')
@@ -86,9 +161,7 @@ def ct_phantom(names, n, type, metal=None):
 		t = [1, 0.8, 0.8, 0.0, 0.0, 0]
 		x = phantom(t, n)
 
-		for index, value in np.ndenumerate(x):
-			if value >= 1: # inside the ellipse
-				x[index] = tissue
+		x[x >= 1] = tissue # inside the ellipse
 
 	elif type == 2:
 		
@@ -102,9 +175,7 @@ def ct_phantom(names, n, type, metal=None):
 		t = [1, 0.8, 0.8, 0.0, 0.0, 0]
 		x = phantom(t, n)
 
-		for index, value in np.ndenumerate(x):
-			if value >= 1:
-				x[index] = tissue
+		x[x >= 1] = tissue
 
 		for r in np.arange(n * 0.04, n * 0.4, n * 0.04):
 			angles = np.cumsum(np.arange(0, 2*math.pi, n * 0.002 / r))
@@ -120,18 +191,14 @@ def ct_phantom(names, n, type, metal=None):
 				[1, 0.52, 0.45, 0, -0.08, 0]]
 		x = phantom(t, n)
 
-		for index, value in np.ndenumerate(x):
-			if value >= 1:
-				x[index] = tissue
+		x[x >= 1] = tissue
 
 		a = [[1, 0.55, 0.5, -0.35, 0.1, 0],
 			[1, 0.55, 0.5, 0.35, 0.1, 0],
 			[1, 0.5, 0.43, 0, -0.08, 0]]
 		x = x + phantom(a, n)
 
-		for index, value in np.ndenumerate(x):
-			if value > tissue:
-				x[index] = adipose
+		x[x > tissue] = adipose
 
 		t =  [[1, 0.37, 0.35, -0.42, 0.03, 0],
 			[1, 0.37, 0.35, 0.42, 0.03, 0],
@@ -140,9 +207,7 @@ def ct_phantom(names, n, type, metal=None):
 			[1, 0.4, 0.2, 0, -0.15, 0]]
 		x = x + phantom(t, n)
 
-		for index, value in np.ndenumerate(x):
-			if value > adipose:
-				x[index] = tissue
+		x[x > adipose] = tissue
 
 		b = [[1, 0.16, 0.12, -0.54, -0.01, 0],
 			[-1, 0.11, 0.10, -0.53, -0.01, 0],
@@ -158,9 +223,7 @@ def ct_phantom(names, n, type, metal=None):
 			[-1, 0.14, 0.03, 0.05, -0.15, -100]]
 		x = x + phantom(b, n)
 
-		for index, value in np.ndenumerate(x):
-			if value > tissue:
-				x[index] = bone
+		x[x > tissue] = bone
 		
 		# this adds a metal implant
 		if nmetal > tissue:
@@ -191,15 +254,12 @@ def ct_phantom(names, n, type, metal=None):
 			
 			x = x + phantom(m, n)
 
-			for index, value in np.ndenumerate(x):
-				if value > bone:
-					x[index] = nmetal
+			x[x > bone] = nmetal
 
 	# make sure the remainder is set to air
-	for index, value in np.ndenumerate(x):
-		if value == 0:
-			x[index] = air
+	x[x == 0] = air
 
-	x = np.flipud(x)
+	# store as the smallest integer type which can hold every material index
+	x = np.flipud(x).astype(np.min_scalar_type(len(names) - 1))
 	
 	return x
\ No newline at end of file
@@ -1,70 +1,262 @@
 import numpy as np
-import scipy
-from scipy import ndimage
 from ct_detect import ct_detect
+from ct_noise import ct_noise
+from projector import interpolation_weights
 import math
-import sys
+import threading
+import collections
+import concurrent.futures
+from ct_trace import progress
 
-def ct_scan(photons, material, phantom, scale, angles, mas=10000):
+def material_labels(phantom, count, air):
+
+	"""labels, materials = material_labels(phantom, count, air) returns an
+	integer image labels with the material index of each pixel in phantom,
+	and the list of materials, other than air, which phantom contains.
+	Integer phantoms which only contain indices less than count, such as
+	those from ct_phantom, are used as they are without making a copy, and
+	otherwise pixels which are not a material index are labelled count."""
+
+	phantom = np.asarray(phantom)
+	if (phantom.dtype.kind in 'ui') and (phantom.size > 0) and (phantom.min() >= 0) and (phantom.max() < count):
+		labels = phantom
+	else:
+		labels = np.full(phantom.shape, count, dtype=np.min_scalar_type(count))
+		for m in range(0, count):
+			labels[phantom == m] = m
+
+	present = np.bincount(labels.ravel(), minlength=count + 1)
+	materials = [m for m in range(0, count) if (m != air) and (present[m] > 0)]
+
+	return labels, materials
+
+def ct_scan(photons, material, phantom, scale, angles, mas=10000, projector=None, tile=2**18, batch=8, rng=None, electronic=0, realizations=None, dtype=float, out=None, workers=None):
 
 	"""simulate CT scanning of an object
 	scan = ct_scan(photons, material, phantom, scale, angles, mas) takes a phantom
 	which contains indices relating to the attenuation coefficients given in
 	material.coeffs, and scans it using source energy photons, with given angles and
-	current-time product mas.
+	current-time product mas. As in ct_detect, mas is not used, and photons
+	must already be the number of photons for this mas and pixel size.
 
 	scale is the pixel size of the input array phantom, in cm per pixel.
+
+	scan = ct_scan(photons, material, phantom, scale, angles, mas, projector)
+	uses the given Projector (see get_projector) to scan all materials and
+	angles with a single sparse matrix product, which is faster when the same
+	geometry is scanned many times.
+
+	phantom is best given as a compact integer image of material indices, as
+	returned by ct_phantom, which is scanned without making any single
+	material copies. tile is the number of rotated pixels which are
+	interpolated at once.
+
+	phantom can also be a volume (slices x n x n), in which case scan is of
+	size (slices x angles x n). The rotated coordinates and interpolation
+	weights are only worked out once for all slices, and are applied to
+	batch slices at a time.
+
+	scan = ct_scan(..., rng=rng, electronic=electronic) adds Poisson and
+	electronic noise to the detections, drawn using the numpy random
+	Generator or seed rng, as in ct_detect. If realizations is given, the
+	noiseless scan is worked out once and that many noise realizations of it
+	are returned in scan (realizations x angles x n), or (realizations x
+	slices x angles x n) for a volume.
+
+	The material depths along each ray are found by ct_depth, and do not
+	depend on the source, so can be shared between scans with different
+	sources. ct_scan turns the depths of each angle into detections as soon
+	as they are found, using depth_angles, so the depths of all of the
+	angles are never stored at once.
+
+	The depths and detections are stored with type dtype, such as
+	np.float32 to halve the memory used, and the scan is written to out, if
+	given, which must be a contiguous array of the size of scan (without
+	realizations).
+
+	If workers is given, the angles are scanned by a pool of that many
+	threads, with at most two angles per worker in progress at once, which
+	gives exactly the same result.
 	"""
 
+	materials, depths = depth_angles(material, phantom, scale, angles, projector, tile, batch, dtype, workers)
+
+	# calculate detections for all of the materials and slices of each angle
+	# at once, as soon as its depths are known
+	shape = (phantom.shape[0] if phantom.ndim == 3 else 1, angles, max(phantom.shape[-2:]))
+	if out is None:
+		scan = np.empty(shape, dtype=dtype)
+	elif (out.size != np.prod(shape)) or not out.flags.c_contiguous:
+		raise ValueError('out must be a contiguous array of the same size as the scan')
+	else:
+		scan = out.reshape(shape)
+	coeffs = material.coeffs[materials]
+	for angle, depth in enumerate(depths):
+		scan[:, angle] = ct_detect(photons, coeffs, depth.reshape((len(materials), -1)), dtype=scan.dtype).reshape(depth.shape[1:])
+	scan = scan.reshape(shape if phantom.ndim == 3 else shape[1:])
+
+	# a single noise realization replaces the noiseless scan
+	if (rng is not None) and (realizations is None):
+		scan[...] = scan_noise(scan, rng, electronic)
+		return scan
+
+	return scan_noise(scan, rng, electronic, realizations)
+
+def ct_depth(material, phantom, scale, angles, projector=None, tile=2**18, batch=8, dtype=float, workers=None):
+
+	"""depth, materials = ct_depth(material, phantom, scale, angles) returns
+	the depth, in cm, of each material along each ray when the phantom is
+	scanned at the given number of angles, as for ct_scan. depth is of size
+	(len(materials) x slices x angles x n), where materials are the indices
+	of the materials which phantom contains, together with air, which makes
+	the depth along every ray up to twice the side length of phantom. A
+	single image phantom is treated as a volume with one slice.
+
+	projector, tile, batch and workers are as for ct_scan. The depths along
+	each ray are added up in double precision, and returned with type dtype."""
+
+	materials, depths = depth_angles(material, phantom, scale, angles, projector, tile, batch, dtype, workers)
+	depth = np.empty((len(materials), phantom.shape[0] if phantom.ndim == 3 else 1, angles, max(phantom.shape[-2:])), dtype=dtype)
+	for angle, d in enumerate(depths):
+		depth[:, :, angle] = d
+
+	return depth, materials
+
+def depth_angles(material, phantom, scale, angles, projector=None, tile=2**18, batch=8, dtype=float, workers=None):
+
+	"""materials, depths = depth_angles(material, phantom, scale, angles)
+	returns the materials of ct_depth, and an iterator depths which gives
+	the depth of each material along each ray of one angle at a time, of
+	size (len(materials) x slices x n), so that the depths of every angle
+	do not need to be stored at once. The arguments are as for ct_depth."""
+
 	# find the coefficients for air
 	air = material.name.index('Air')
 
-	# get input image dimensions, and create a coordinate structure
-	n = max(phantom.shape)
-	xi, yi = np.meshgrid(np.arange(n) - (n/2) + 0.5, np.arange(n) - (n/2) + 0.5)
+	# get input image dimensions, and create a coordinate structure, treating
+	# a single image as a volume with one slice
+	if phantom.ndim != 3:
+		phantom = phantom[np.newaxis]
+	slices = phantom.shape[0]
+	n = max(phantom.shape[1:])
+	axis = np.arange(n) - (n/2) + 0.5
+	count = len(material.coeffs)
+
+	# check which materials phantom actually contains, and label each pixel
+	# with its material index
+	labels, materials = material_labels(phantom, count, air)
+	keep = sorted(materials + [air])
+
+	if projector is not None:
+		if (projector.n != n) or (projector.angles != angles):
+			raise ValueError('projector has different geometry to input phantom and angles')
 
-	# check which materials phantom actually contains, and create single
-	# material phantoms for each of these, except for air
-	materials = []
-	material_phantom = []
-	for m in range(0,len(material.coeffs)):
-		z0 = (phantom == m).astype(float)
-		if (m != air) & (z0.sum()>0):
-			materials.append(m)
-			material_phantom.append(z0)
+		# scan all angles and materials at once, using single material phantoms
+		depth = np.zeros((slices, count, angles, n))
+		if len(materials) > 0:
+			depth[:, materials] = projector.forward(np.stack([(labels == m) for m in materials], axis=1).astype(float))
+		depth = np.clip(depth, 0, None)
+		depth[:, air] = 2 * n - np.sum(depth, axis=1)
+		depth *= scale
+
+		depth = np.ascontiguousarray(depth[:, keep].transpose((1, 0, 2, 3)), dtype=dtype)
+		return keep, (depth[:, :, angle] for angle in range(angles))
+
+	# each output sample is the sum down one column of the rotated phantom,
+	# which is worked out a tile of rows at a time so that the interpolation
+	# weights, which are the only floating point copies of the phantom, are
+	# of bounded size. The same weights are used for batch slices at a time.
+	labels = labels.reshape((slices, -1))
+	batch = max(1, min(slices, batch))
+	rows = max(1, min(n, tile // (n * batch)))
+	columns = np.arange(n)
+	offsets = (np.arange(batch) * (count + 1))[:, np.newaxis, np.newaxis, np.newaxis]
 
-	# scan one angle at a time
-	scan = np.zeros((angles, n)) # per angle per phantom
-	for angle in range(angles):
+	# each angle is worked out separately, with a buffer for each thread, so
+	# they can be shared between workers threads without changing the result
+	local = threading.local()
 
-		sys.stdout.write("Scanning angle: %d   \r" % (angle + 1) )
+	def scan_angle(angle):
+
+		if not hasattr(local, 'depth'):
+			local.depth = np.zeros((slices, (count + 1) * n))
+		depth = local.depth
 
-		# Get rotated coordinates for interpolation
 		p = -math.pi / 2 - angle * math.pi / angles
-		x0 = xi * math.cos(p) - yi * math.sin(p) + (n/2) - 0.5
-		y0 = xi * math.sin(p) + yi * math.cos(p) + (n/2) - 0.5
+		depth[...] = 0
+		for start in range(0, n, rows):
+
+			# Get rotated coordinates for interpolation
+			xi = axis[np.newaxis, :]
+			yi = axis[start:start + rows, np.newaxis]
+			x0 = xi * math.cos(p) - yi * math.sin(p) + (n/2) - 0.5
+			y0 = xi * math.sin(p) + yi * math.cos(p) + (n/2) - 0.5
 
-		# For each material, add up how many pixels contain this on each ray
-		depth = np.zeros((len(material.coeffs), n))
+			# For all materials at once, add up how many pixels contain each one on
+			# each ray, by sharing the linear interpolation weights between
+			# materials and slices and accumulating each weight into its
+			# (slice, material, ray)
+			index, weight = interpolation_weights([y0, x0], phantom.shape[1:])
+			for first in range(0, slices, batch):
+				last = min(first + batch, slices)
+				key = labels[first:last, index].astype(np.intp)
+				key += offsets[:last - first]
+				key *= n
+				key += columns
+				weights = np.broadcast_to(weight, key.shape)
+				depth[first:last] += np.bincount(key.ravel(), weights=weights.ravel(), minlength=(last - first) * (count + 1) * n).reshape((last - first, -1))
 
-		for index, m in enumerate(materials):
-			interpolated = scipy.ndimage.map_coordinates(material_phantom[index], [y0, x0], order=1, mode='constant', cval=0, prefilter=False) # order=1 linear interpolation
-			depth[m] = np.sum(interpolated, axis=0)
+		# materials x (slices x samples)
+		d = depth.reshape((slices, count + 1, n))[:, :count].transpose((1, 0, 2)).reshape((count, slices * n))
+		d[air] = 0
 
 		# only necessary for more complex forms of interpolation above
-		depth = np.clip(depth, 0, None) # avoid negative depth by overshooting
+		d = np.clip(d, 0, None) # avoid negative depth by overshooting
 
 		# ensure an appropriate amount of air is included in the calculation
 		# to account for the scan being circular, but the phantom being square
 		# diameter of circle taken to be twice the phantom side length
-		depth[air] = 2 * n - np.sum(depth, axis=0)
+		d[air] = 2 * n - np.sum(d, axis=0)
 
-		# scale the depth appropriately and calculate detections for this set of
-		# materials
-		depth *= scale
-	
-		scan[angle] = ct_detect(photons, material.coeffs, depth, mas)
-	
-	sys.stdout.write("\n")
+		# scale the depth appropriately for this set of materials
+		d *= scale
+
+		return d[keep].reshape((len(keep), slices, n)).astype(dtype, copy=False)
+
+	# give the depths of each angle in turn, with at most two angles per
+	# worker in progress at once
+	def scan_angles():
+
+		if (workers is None) or (workers <= 1):
+			for angle in range(angles):
+				yield scan_angle(angle)
+				progress('ct_scan', angle + 1, angles)
+			return
+
+		with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+			pending = collections.deque()
+			done = 0
+			for angle in range(angles):
+				pending.append(pool.submit(scan_angle, angle))
+				if len(pending) >= 2 * workers:
+					done += 1
+					yield pending.popleft().result()
+					progress('ct_scan', done, angles)
+			while pending:
+				done += 1
+				yield pending.popleft().result()
+				progress('ct_scan', done, angles)
+
+
+	return keep, scan_angles()
+
+def scan_noise(scan, rng=None, electronic=0, realizations=None):
+
+	"""scan = scan_noise(scan, rng, electronic, realizations) adds noise to
+	the noiseless scan from ct_scan, as in ct_detect, if rng is given"""
+
+	if rng is None:
+		return scan
 
-	return scan
\ No newline at end of file
+	# minimum detection is one photon
+	return np.clip(ct_noise(scan, rng, electronic, realizations), 1, None)
@@ -8,6 +8,10 @@ from ct_phantom import *
 from ct_lib import *
 from scan_and_reconstruct import *
 from create_dicom import *
+from xtreme import Xtreme, write_rsq
+from ct_trace import Trace
+import os
+import tempfile
 
 # create object instances
 material = Material()
@@ -85,8 +89,193 @@ def test_shape():
 			
 	# Results: Assures accuracy of reconstructed shape up to 2 pixels tolerence, which corresponds to minor negligible 
 	
+def test_precision(material):
+	# Check that reconstructing in single precision, which halves the memory used by each stage,
+	# gives the same Hounsfield Units as double precision, for a phantom with bone and a metal implant
+
+	p = ct_phantom(material.name, 256, 3)
+	s = source.photon('100kVp, 3mm Al')
+	y64 = scan_and_reconstruct(s, material, p, 0.1, 256)
+	y32 = scan_and_reconstruct(s, material, p, 0.1, 256, dtype=np.float32)
+
+	difference = np.abs(y64 - y32)
+	assert y32.dtype == np.float32
+	assert np.max(difference) < 0.005
+	print(np.max(difference), np.mean(difference))
+
+	# Results: The largest difference is 0.0042 HU, within the 0.005 HU asserted, and the mean 0.0003 HU, far below the noise in any real scan.
+
+def test_fan_to_parallel():
+	# Check that fan_to_parallel keeps the shape of its input, so that a stack of one slice is
+	# still a stack, and that converting a stack gives the same as converting each slice in turn
+
+	with tempfile.TemporaryDirectory() as directory:
+		filename = os.path.join(directory, 'test.rsq')
+		write_rsq(filename, 64, scans=3)
+		x = Xtreme(filename)
+		Y = np.array([x.get_rsq_slice(scan)[0] for scan in range(3)])
+
+		single = x.fan_to_parallel(Y[0])
+		stack = x.fan_to_parallel(Y)
+		assert single.ndim == 2
+		assert x.fan_to_parallel(Y[:1]).shape == (1,) + single.shape
+		assert stack.shape == (3,) + single.shape
+		for scan in range(3):
+			assert np.array_equal(stack[scan], x.fan_to_parallel(Y[scan]))
+		print(stack.shape)
+
+	# Results: A (1 x angles x samples) input gives a (1 x recon_angles x samples) output, and the stack matches each slice exactly.
+
+def test_trace_workers():
+	# Check that the stages of slices reconstructed in worker processes are recorded in the trace
+	# of the parent process, as they are when reconstructing with a single worker
+
+	with tempfile.TemporaryDirectory() as directory:
+		filename = os.path.join(directory, 'test.rsq')
+		write_rsq(filename, 64, scans=4)
+		x = Xtreme(filename)
+
+		for workers in [1, 2]:
+			with Trace() as trace:
+				slices = list(x.reconstruct_slices(range(4), workers=workers))
+			summary = trace.summary()
+			assert len(slices) == 4
+			for name in ['read', 'fan_to_parallel', 'ramp_filter', 'back_project']:
+				assert summary[name]['calls'] == 4
+			print(workers, sorted(summary), len(set(record.get('process') for record in trace.records)))
+
+	# Results: Every stage of every slice is traced with one or two workers, and with two workers the records come from the worker processes.
+
+def write_disc_rsq(filename, samples, scans, radius, centre, mu):
+	# Write a synthetic Xtreme RSQ file of a cylinder of the given radius and centre, in samples, and linear
+	# attenuation coefficient mu per sample, by projecting it through the fan geometry of the scanner
+
+	write_rsq(filename, samples, scans)
+	x = Xtreme(filename)
+
+	# fan angle of each sample, and source angle of each angle, as used by fan_to_parallel
+	fan = np.linspace(-0.6 * x.fan_theta, 0.6 * x.fan_theta, 20001)
+	gamma = np.interp(np.arange(x.samples), x.detector_position(fan), fan)
+	beta = (np.arange(x.angles) - (x.skip_angles / 2 + x.fan_angles / 2 - 0.5)) * x.dtheta
+
+	# length of each ray through the cylinder
+	theta = beta[:, np.newaxis] - gamma
+	distance = x.radius * np.sin(gamma) + np.sin(theta) * centre[0] + np.cos(theta) * centre[1]
+	chord = 2 * np.sqrt(np.clip(radius ** 2 - distance ** 2, 0, None))
+
+	data = np.memmap(filename, np.int16, 'r+', offset=(int(x.data_offset) + 1) * 512, shape=x.rsq_data().shape)
+	valid = slice(x.left_samples, x.left_samples + x.samples)
+	data[:, 0, valid] = 100
+	data[:, 1, valid] = 30000
+	data[:, 2:, valid] = np.round(100 + 29900 * np.exp(-mu * chord)).astype(np.int16)
+	data.flush()
+	del data
+
+	return Xtreme(filename)
+
+def test_fdk():
+	# Check that the FDK reconstruction of a z-fan, and the fan-beam reconstruction with Parker weights of each
+	# slice, agree with the parallel-beam reconstruction of each slice, for an off-centre cylinder which is the
+	# same in every slice, and that they all recover the cylinder. The cylinder is off-centre so that its rays
+	# are weighted differently at each angle, and getting the short scan weights wrong gives errors of 80 HU
+
+	with tempfile.TemporaryDirectory() as directory:
+		x = write_disc_rsq(os.path.join(directory, 'disc.rsq'), 64, 30, 12, (8, -5), 0.02)
+
+		# with mu_water set to that of the cylinder, the cylinder is 0 HU and the air around it -1000 HU
+		mu_water = 0.02 / x.scale
+		n = x.samples
+		xi, yi = np.meshgrid(np.arange(n) - n / 2 + 0.5, np.arange(n) - n / 2 + 0.5)
+		inside = np.hypot(xi - 8, yi + 5) < 8
+		circle = np.hypot(xi, yi) < 26
+
+		volume = x.reconstruct_fan(0, mu_water=mu_water)
+		for k, scan in enumerate(range(x.skip_scans, x.fan_scans - x.skip_scans)):
+			parallel = x.reconstruct_slice(scan, mu_water=mu_water)
+			fan = x.reconstruct_slice(scan, mu_water=mu_water, method='fan')
+			for y in [parallel, fan, volume[k]]:
+				assert abs(np.mean(y[inside])) < 50
+			assert np.mean(np.abs(fan - parallel)[circle]) < 20
+			assert np.mean(np.abs(volume[k] - parallel)[circle]) < 20
+		print(np.mean(parallel[inside]), np.mean(fan[inside]), np.mean(volume[k][inside]),
+			np.mean(np.abs(fan - parallel)[circle]), np.mean(np.abs(volume[k] - parallel)[circle]))
+
+	# Results: All three recover the cylinder to within 3 HU of 0 HU inside it, and the fan-beam and FDK
+	# reconstructions both differ from the parallel-beam one by about 7 HU on average over the reconstructed
+	# circle, mostly at the edge of the cylinder, against 80 HU or more with wrong or no Parker weights.
+
+def test_os_sart(material):
+	# Check that with only a few angles, the OS-SART reconstruction is closer than filtered back-projection to
+	# a reconstruction from many angles, and that os_sart stops early once the residual stops improving
+
+	p = ct_phantom(material.name, 128, 3)
+	s = source.photon('100kVp, 3mm Al')
+	reference = scan_and_reconstruct(s, material, p, 0.2, 256)
+	fbp = scan_and_reconstruct(s, material, p, 0.2, 16)
+	iterative = scan_and_reconstruct(s, material, p, 0.2, 16, method='os_sart')
+
+	xi, yi = np.meshgrid(np.arange(128) - 63.5, np.arange(128) - 63.5)
+	circle = np.hypot(xi, yi) < 63
+	fbp_error = np.mean(np.abs(fbp - reference)[circle])
+	iterative_error = np.mean(np.abs(iterative - reference)[circle])
+	assert iterative_error < 0.6 * fbp_error
+
+	# count the passes through the subsets from the progress of os_sart
+	sinogram = ct_calibrate(s, material, ct_scan(s, material, p, 0.2, 16), 0.2)
+	passes = {}
+	for tol in [0, 0.1]:
+		def count(name, done, total):
+			if name == 'os_sart':
+				passes[tol] = done
+		with Trace(progress=count):
+			os_sart(sinogram, 0.2, iterations=20, tol=tol)
+	assert passes[0] == 20
+	assert passes[0.1] < 20
+	print(fbp_error, iterative_error, passes)
+
+	# Results: At 16 angles the mean error is about 165 HU for OS-SART against 420 HU for filtered back-projection,
+	# and with a tolerance of 0.1 it stops after a few passes rather than all 20.
+
+def test_dicom_series():
+	# Check that a volume written by DicomSeries, as separate files or as one multi-frame file, is read back
+	# by read_dicom_series with the same HU values, in the same order, and with the same spacing
+
+	rng = np.random.default_rng(0)
+	x = rng.integers(-1024, 3072, size=(5, 32, 32)).astype(float)
+
+	with tempfile.TemporaryDirectory() as directory:
+		for multiframe in [False, True]:
+			name = 'frames' if multiframe else 'files'
+			with DicomSeries(name, 0.5, 2.0, storage_directory=directory, multiframe=multiframe) as series:
+				for f in reversed(range(5)):
+					series.write(x[f], f + 1)
+
+			filenames = os.path.join(directory, name + ('.dcm' if multiframe else '_*.dcm'))
+			y, sp, sz = read_dicom_series(filenames)
+			assert np.array_equal(y, x)
+			assert (float(sp), sz) == (0.5, 2.0)
+
+			mapped, sp, sz = read_dicom_series(filenames, memmap=os.path.join(directory, name + '.raw'))
+			assert np.array_equal(mapped, x)
+			del mapped
+			print(name, y.shape, sp, sz)
+
+	# Results: Both layouts give back exactly the volume which was written, even with the frames written out of order.
+
 # Run the various tests
 # print("Shape test")
 # test_shape()
 print("Value test")
 test_value(material)
+print("Precision test")
+test_precision(material)
+print("Fan to parallel test")
+test_fan_to_parallel()
+print("Trace workers test")
+test_trace_workers()
+print("FDK test")
+test_fdk()
+print("OS-SART test")
+test_os_sart(material)
+print("DICOM series test")
+test_dicom_series()
@@ -0,0 +1,205 @@
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+# traces which are currently collecting, the most recent last
+_active = []
+
+class Trace(object):
+	def __init__(self, progress=None, memory=False):
+
+		"""Trace records how long each stage of the CT process takes
+		trace = Trace(progress, memory) collects a record of each stage which
+		is run while it is active, which is done using it in a with
+		statement:
+
+			with Trace() as trace:
+				y = scan_and_reconstruct(...)
+			trace.save_chrome('trace.json')
+
+		Each record contains the stage 'name', the start time 'start' and
+		wall time 'wall' in seconds since the trace started, the processor
+		time 'cpu' in seconds, and the nesting 'depth'.
+
+		If memory is True, memory allocations are traced using tracemalloc,
+		and each record also contains 'peak', the largest amount of memory
+		allocated during the stage, and 'allocated', the amount still
+		allocated at the end, both in bytes and relative to the start of the
+		stage. This slows down stages which allocate many small objects.
+
+		progress is an optional function progress(stage, done, total) which
+		is called as each stage progresses, such as after each angle is
+		scanned, where done runs from 1 to total. print_progress can be used
+		to show this on the console.
+
+		Stages run in worker processes, such as by
+		Xtreme.reconstruct_slices, are traced in those processes with
+		traced, and added to the trace with merge, with 'process' set to
+		the worker process ID. Their progress is only reported by the
+		parent process, as each result arrives."""
+
+		self.progress = progress
+		self.memory = memory
+		self.records = []
+		self._stack = []
+		self._origin = None
+		self._started_tracing = False
+		self._lock = threading.Lock()
+
+	def __enter__(self):
+		self._origin = time.perf_counter()
+		if self.memory and not tracemalloc.is_tracing():
+			tracemalloc.start()
+			self._started_tracing = True
+		_active.append(self)
+		return self
+
+	def __exit__(self, *args):
+		_active.remove(self)
+		if self._started_tracing:
+			tracemalloc.stop()
+			self._started_tracing = False
+
+	@contextlib.contextmanager
+	def stage(self, name, **info):
+
+		"""with trace.stage(name, **info): records the code in the with
+		statement as the stage name, with any extra information in info"""
+
+		record = dict(name=name, depth=len(self._stack), **info)
+		if self.memory:
+			current, peak = tracemalloc.get_traced_memory()
+			if self._stack:
+				self._stack[-1]['_peak'] = max(self._stack[-1]['_peak'], peak)
+			tracemalloc.reset_peak()
+			record['_base'] = current
+			record['_peak'] = current
+		self._stack.append(record)
+
+		start = time.perf_counter()
+		cpu = time.process_time()
+		try:
+			yield record
+		finally:
+			record['wall'] = time.perf_counter() - start
+			record['cpu'] = time.process_time() - cpu
+			record['start'] = start - self._origin
+			self._stack.pop()
+
+			if self.memory:
+				current, peak = tracemalloc.get_traced_memory()
+				peak = max(peak, record.pop('_peak'))
+				base = record.pop('_base')
+				record['peak'] = peak - base
+				record['allocated'] = current - base
+				if self._stack:
+					self._stack[-1]['_peak'] = max(self._stack[-1]['_peak'], peak)
+
+			with self._lock:
+				self.records.append(record)
+
+	def merge(self, records):
+
+		"""trace.merge(records) adds the records from traced, such as from
+		a worker process, to the trace, nested within the current stage"""
+
+		with self._lock:
+			for record in records:
+				record = dict(record)
+				record['start'] -= self._origin
+				record['depth'] += len(self._stack)
+				self.records.append(record)
+
+	def summary(self):
+
+		"""returns a dictionary of the total wall time, processor time and
+		number of calls of each stage, by name"""
+
+		totals = {}
+		for record in self.records:
+			total = totals.setdefault(record['name'], {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+			total['wall'] += record['wall']
+			total['cpu'] += record['cpu']
+			total['calls'] += 1
+			if 'peak' in record:
+				total['peak'] = max(total.get('peak', 0), record['peak'])
+
+		return totals
+
+	def save_json(self, filename):
+
+		"""saves the records and summary of the trace to a JSON file"""
+
+		with open(filename, 'w') as f:
+			json.dump({'records': sorted(self.records, key=lambda r: r['start']), 'summary': self.summary()}, f, indent=1)
+
+	def save_chrome(self, filename):
+
+		"""saves the trace to a JSON file in the Chrome trace event format,
+		which can be viewed in chrome://tracing or Perfetto"""
+
+		events = []
+		for record in self.records:
+			args = {k: v for k, v in record.items() if k not in ('name', 'start', 'wall')}
+			events.append({'name': record['name'], 'ph': 'X', 'ts': record['start'] * 1e6,
+				'dur': record['wall'] * 1e6, 'pid': record.get('process', os.getpid()), 'tid': 0, 'args': args})
+
+		with open(filename, 'w') as f:
+			json.dump({'traceEvents': sorted(events, key=lambda e: e['ts']), 'displayTimeUnit': 'ms'}, f)
+
+
+def stage(name, **info):
+
+	"""with stage(name, **info): records the code in the with statement as
+	the stage name in the active Trace, if there is one, and otherwise does
+	nothing"""
+
+	if not _active:
+		return contextlib.nullcontext()
+
+	return _active[-1].stage(name, **info)
+
+def progress(name, done, total):
+
+	"""progress(name, done, total) reports that done out of total steps of
+	the stage name have been completed to the progress function of the
+	active Trace, if there is one"""
+
+	if _active and (_active[-1].progress is not None):
+		_active[-1].progress(name, done, total)
+
+def current():
+
+	"""returns the active Trace, or None if there is not one"""
+
+	return _active[-1] if _active else None
+
+def traced(memory, func, *args):
+
+	"""result, records = traced(memory, func, *args) returns func(*args),
+	and the records of the stages it ran, traced as by Trace(None, memory),
+	for adding to the trace of another process with Trace.merge. The start
+	times are those of time.perf_counter, which is shared by all processes
+	on the same machine, and each record is labelled with this 'process'."""
+
+	with Trace(None, memory) as trace:
+		result = func(*args)
+
+	for record in trace.records:
+		record['start'] += trace._origin
+		record['process'] = os.getpid()
+
+	return result, trace.records
+
+def print_progress(name, done, total):
+
+	"""a progress function for Trace, which shows the progress of each stage
+	on the console"""
+
+	sys.stdout.write("%s: %d / %d   \r" % (name, done, total))
+	if done == total:
+		sys.stdout.write("\n")
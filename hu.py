@@ -1,30 +1,25 @@
 import numpy as np
-from attenuate import *
-from ct_calibrate import *
-from ct_detect import *
+from calibration import get_calibration
 
-def hu(p, material, reconstruction, scale):
+def hu(p, material, reconstruction, scale, out=None):
 	""" convert CT reconstruction output to Hounsfield Units
 	calibrated = hu(p, material, reconstruction, scale) converts the reconstruction into Hounsfield
-	Units, using the material coefficients, photon energy p and scale given."""
+	Units, using the material coefficients, photon energy p and scale given.
+	The result has the same type as reconstruction if it is floating point,
+	or is written to out if given, which can be reconstruction itself."""
  
  #attenuate to get residual energy through water and then calibrate to get total attenuation coefficient
-	print('p shape is', p.shape)
-	n = reconstruction.shape[1]
-	depth = 2 * n * scale  # for the fixed distance between source and detector
-	water_idx = material.name.index('Water')
-	water_coeff = material.coeffs[water_idx]
-	water_energy = np.array(ct_detect(p, water_coeff, depth), ndmin=2)
-	print('water_energy shape is', water_energy.shape)
-	calibrated = ct_calibrate(p, material, water_energy, scale)
-	mu_water = calibrated/depth
+	n = reconstruction.shape[-1]
+	mu_water = get_calibration(p, material, scale, n).mu_water
  
-	print('mu_water shape is',mu_water.shape)
- 
-	hu = ((reconstruction-mu_water)/ mu_water) * 1000
+	if out is None:
+		out = np.empty(reconstruction.shape, dtype=reconstruction.dtype if reconstruction.dtype.kind == 'f' else float)
+	hu = np.subtract(reconstruction, mu_water, out=out)
+	hu /= mu_water
+	hu *= 1000
 	# g = ((hu-center)/width) * 128 +128
 	# g = np.clip(g, 0, 255)
-	clipped = np.clip(hu, -1024.0, 3072.0)
+	clipped = np.clip(hu, -1024.0, 3072.0, out=hu)
   
 	# use water to calibrate
 
@@ -0,0 +1,92 @@
+import numpy as np
+from ramp_filter import *
+from back_project import *
+from projector import get_projector
+from ct_trace import progress
+
+def os_sart(sinogram, scale, subsets=8, iterations=10, relaxation=1.0, tol=1e-3, x0=None, alpha=0.001, projector=None):
+
+	""" Ordered-subset simultaneous algebraic reconstruction (OS-SART)
+
+	reconstruction = os_sart(sinogram, scale) iteratively reconstructs the
+	calibrated sinogram (angles x samples), such as from ct_calibrate,
+	whose pixels are of size scale in cm. The output is the same as from
+	back_project(ramp_filter(sinogram, scale)): the linear attenuation
+	coefficient in each pixel, with pixels outside the reconstructed circle
+	set to -1.
+
+	The rays are those of ct_scan, from the forward matrix of the Projector
+	for the geometry (see get_projector), or projector if given, and the
+	reconstruction is corrected by its transpose. The angles are split into
+	subsets interleaved groups, and the reconstruction is updated from one
+	subset at a time, which converges in far fewer passes than using all of
+	the angles at once. relaxation is the step size of each update, and the
+	attenuation is kept non-negative.
+
+	The reconstruction starts from the filtered back-projection, with
+	raised-cosine power alpha, or from x0 if given, and stops after
+	iterations passes through all of the subsets, or earlier once the
+	residual of a pass is less than tol relative to the sinogram, or
+	improves on the previous pass by less than tol of itself.
+
+	sinogram can also be a stack of sinograms (slices x angles x samples),
+	which are all reconstructed at once with the same matrices. The matrix
+	of each subset is only stored once, transposed, and is kept by the
+	projector for later reconstructions (see Projector.subset_matrices)."""
+
+	# get input dimensions, treating a single sinogram as one slice
+	n = sinogram.shape[-1]
+	angles = sinogram.shape[-2]
+	stack = sinogram.reshape((-1, angles, n))
+	slices = stack.shape[0]
+
+	if projector is None:
+		projector = get_projector(n, angles)
+	if (projector.n != n) or (projector.angles != angles):
+		raise ValueError('projector has different geometry to input sinogram')
+
+	# the sum along each ray is scale times the sum of the pixels it passes
+	# through, so the data are divided by scale, and each column holds a slice
+	p = stack.transpose((1, 2, 0)).reshape((angles * n, slices)) / scale
+
+	# starting reconstruction, with pixels (n*n x slices)
+	if x0 is None:
+		x0 = back_project(ramp_filter(stack, scale, alpha))
+	x = np.clip(np.asarray(x0, dtype=float).reshape((slices, n * n)).T, 0, None)
+
+	# the rows of each subset of interleaved angles, the transpose of those
+	# rows, and the row and column sums used to normalise the updates, which
+	# are kept by the projector for the next reconstruction
+	subsets = max(1, min(int(subsets), angles))
+	matrices = projector.subset_matrices(subsets)
+
+	total = np.linalg.norm(p)
+	previous = None
+	for iteration in range(iterations):
+
+		residual = 0
+		for r, mt, row_sums, column_sums in matrices:
+			error = p[r] - mt.T @ x
+			residual += np.sum(error ** 2)
+			error *= row_sums
+			update = mt @ error
+			update *= column_sums
+			update *= relaxation
+			x += update
+			np.clip(x, 0, None, out=x)
+
+		progress('os_sart', iteration + 1, iterations)
+
+		# stop once the residual is small enough, or no longer improving
+		residual = np.sqrt(residual)
+		if (residual <= tol * total) or ((previous is not None) and (previous - residual <= tol * previous)):
+			break
+		previous = residual
+
+	reconstruction = x.T.reshape(stack.shape[:1] + (n, n))
+
+	# ensure any data outside the reconstructed circle is set to invalid
+	xi, yi = np.meshgrid(np.arange(n) - (n/2) + 0.5, np.arange(n) - (n/2) + 0.5)
+	reconstruction[:, (xi ** 2 + yi ** 2) > (n/2)**2] = -1
+
+	return reconstruction.reshape(sinogram.shape[:-2] + (n, n))
@@ -0,0 +1,196 @@
+import numpy as np
+import math
+import functools
+import scipy
+from scipy import sparse
+
+def interpolation_weights(coordinates, shape):
+
+	"""linear interpolation weights matching map_coordinates
+	index, weight = interpolation_weights(coordinates, shape) takes a list of
+	coordinate arrays (one per dimension of an input of size shape, as would be
+	given to scipy.ndimage.map_coordinates) and returns the flat indices into
+	the input, and the corresponding weights, of the 2^d neighbours used by
+	linear interpolation (order=1, mode='constant', cval=0, prefilter=False).
+	Both outputs are of size (2^d, ...) where ... is the coordinate shape.
+
+	Summing input.ravel()[index] * weight over the first axis gives the same
+	result as map_coordinates, but the indices and weights can be reused for
+	any input of the same shape."""
+
+	dims = len(shape)
+	coordinates = [np.asarray(c, dtype=float) for c in coordinates]
+	if len(coordinates) != dims:
+		raise ValueError('coordinates have different number of dimensions to shape')
+
+	# points outside the input are zero, and interpolation is not
+	# performed beyond the edges of the input
+	valid = np.ones(coordinates[0].shape, dtype=bool)
+	lower = []
+	fraction = []
+	for c, length in zip(coordinates, shape):
+		valid &= (c >= 0) & (c <= length - 1)
+		f = np.floor(c)
+		lower.append(np.clip(f, 0, length - 1).astype(np.intp))
+		fraction.append(c - f)
+
+	# flat index strides for each dimension
+	strides = [int(np.prod(shape[d + 1:])) for d in range(dims)]
+
+	index = np.zeros((2 ** dims,) + valid.shape, dtype=np.intp)
+	weight = np.ones((2 ** dims,) + valid.shape)
+	for corner in range(2 ** dims):
+		for d in range(dims):
+			if (corner >> (dims - 1 - d)) & 1:
+				# upper neighbour, which has zero weight at the last sample
+				index[corner] += np.minimum(lower[d] + 1, shape[d] - 1) * strides[d]
+				weight[corner] *= fraction[d]
+			else:
+				index[corner] += lower[d] * strides[d]
+				weight[corner] *= 1 - fraction[d]
+		weight[corner][~valid] = 0
+
+	return index, weight
+
+
+class Projector(object):
+	def __init__(self, n, angles, skip=1):
+		"""Projector holds the system matrices for scanning and back-projection
+		p = Projector(n, angles, skip) describes the geometry used by ct_scan
+		for an (n x n) phantom scanned at the given number of angles, and by
+		back_project for an (angles x n) sinogram reconstructed every skip
+		samples. The linear interpolation weights for each geometry are built
+		once as scipy.sparse matrices, on first use, so that scanning and
+		back-projection are each a single sparse matrix product.
+
+		The matrices have about 2 * n^2 * angles non-zero entries each, so
+		this is best suited to repeatedly scanning the same geometry. Use
+		get_projector to share instances with the same geometry."""
+
+		self.n = int(n)
+		self.angles = int(angles)
+		self.skip = int(skip)
+		self.samples = int(math.floor((self.n - 1) // self.skip) + 1)
+		self._forward_matrix = None
+		self._back_matrix = None
+		self._subset_matrices = {}
+
+	def forward_matrix(self):
+		"""Given the geometry, this returns the (angles*n x n*n) matrix which
+		sums the interpolated phantom along each ray, as in ct_scan"""
+
+		if self._forward_matrix is None:
+			n = self.n
+			xi, yi = np.meshgrid(np.arange(n) - (n/2) + 0.5, np.arange(n) - (n/2) + 0.5)
+			columns = np.broadcast_to(np.arange(n), (n, n))
+
+			blocks = []
+			for angle in range(self.angles):
+				p = -math.pi / 2 - angle * math.pi / self.angles
+				x0 = xi * math.cos(p) - yi * math.sin(p) + (n/2) - 0.5
+				y0 = xi * math.sin(p) + yi * math.cos(p) + (n/2) - 0.5
+
+				# each ray is the sum down one column of the rotated image
+				index, weight = interpolation_weights([y0, x0], (n, n))
+				rows = np.broadcast_to(columns, index.shape)
+				keep = weight != 0
+				block = sparse.coo_matrix((weight[keep], (rows[keep], index[keep])), shape=(n, n * n))
+				blocks.append(block.tocsr())
+
+			self._forward_matrix = sparse.vstack(blocks, format='csr')
+
+		return self._forward_matrix
+
+	def back_matrix(self):
+		"""Given the geometry, this returns the (samples*samples x angles*n)
+		matrix which back-projects a sinogram, including the factor of
+		dtheta, as in back_project"""
+
+		if self._back_matrix is None:
+			ns = self.n
+			xi, yi = np.meshgrid(np.arange(0, ns, self.skip) - (ns/2) + 0.5, np.arange(0, ns, self.skip) - (ns/2) + 0.5)
+			pixels = np.broadcast_to(np.arange(self.samples * self.samples).reshape(xi.shape), (2,) + xi.shape)
+
+			blocks = []
+			for angle in range(self.angles):
+				p = math.pi / 2 + angle * math.pi / self.angles
+				x0 = xi * math.cos(p) - yi * math.sin(p) + (ns / 2) - 0.5
+
+				index, weight = interpolation_weights([x0], (ns,))
+				keep = weight != 0
+				block = sparse.coo_matrix((weight[keep] * (math.pi / self.angles), (index[keep], pixels[keep])), shape=(ns, self.samples * self.samples))
+				blocks.append(block.tocsr())
+
+			self._back_matrix = sparse.vstack(blocks, format='csr').transpose().tocsr()
+
+		return self._back_matrix
+
+	def subset_matrices(self, subsets):
+		"""Given the geometry, this returns, for each of subsets interleaved
+		groups of angles as used by os_sart, a tuple (rows, transpose,
+		row_sums, column_sums), where rows are the rows of forward_matrix for
+		those angles, transpose is the transpose of just those rows, and
+		row_sums and column_sums are the reciprocals of the sums of its rows
+		and columns, or zero where they are empty. transpose.T gives those
+		rows of forward_matrix without a copy, so together the subsets are
+		the same size as forward_matrix, and are built once for each number
+		of subsets."""
+
+		if subsets not in self._subset_matrices:
+			a = self.forward_matrix()
+			n = self.n
+			matrices = []
+			for s in range(subsets):
+				rows = (np.arange(s, self.angles, subsets)[:, np.newaxis] * n + np.arange(n)).ravel()
+				transpose = a[rows].T.tocsr()
+				row_sums = np.asarray(transpose.sum(axis=0)).ravel()
+				column_sums = np.asarray(transpose.sum(axis=1)).ravel()
+				with np.errstate(divide='ignore'):
+					row_sums = np.where(row_sums > 0, 1 / row_sums, 0)[:, np.newaxis]
+					column_sums = np.where(column_sums > 0, 1 / column_sums, 0)[:, np.newaxis]
+				matrices.append((rows, transpose, row_sums, column_sums))
+			self._subset_matrices[subsets] = matrices
+
+		return self._subset_matrices[subsets]
+
+	def forward(self, x):
+		"""y = forward(x) takes a phantom x (n x n), or a stack of phantoms
+		(k x n x n), and returns the sum along each ray in y (angles x n), or
+		(k x angles x n)"""
+
+		x = np.asarray(x, dtype=float)
+		if x.shape[-2:] != (self.n, self.n):
+			raise ValueError('input has different size to projector geometry')
+		stack = x.reshape((-1, self.n * self.n))
+
+		y = self.forward_matrix() @ stack.T
+		y = y.T.reshape(stack.shape[:1] + (self.angles, self.n))
+
+		return y.reshape(x.shape[:-2] + (self.angles, self.n))
+
+	def back(self, sinogram):
+		"""x = back(sinogram) back-projects sinogram (angles x n) to give
+		the reconstruction x (samples x samples), with any data outside the
+		reconstructed circle set to -1, as in back_project"""
+
+		sinogram = np.asarray(sinogram, dtype=float)
+		if sinogram.shape != (self.angles, self.n):
+			raise ValueError('input sinogram has different size to projector geometry')
+
+		reconstruction = self.back_matrix() @ sinogram.ravel()
+		reconstruction = reconstruction.reshape((self.samples, self.samples))
+
+		# ensure any data outside the reconstructed circle is set to invalid
+		ns = self.n
+		xi, yi = np.meshgrid(np.arange(0, ns, self.skip) - (ns/2) + 0.5, np.arange(0, ns, self.skip) - (ns/2) + 0.5)
+		reconstruction[np.where((xi ** 2 + yi ** 2) > (ns/2)**2)] = -1
+
+		return reconstruction
+
+
+@functools.lru_cache(maxsize=4)
+def get_projector(n, angles, skip=1):
+	"""p = get_projector(n, angles, skip) returns a shared Projector for the
+	given geometry, so that the system matrices are only built once"""
+
+	return Projector(n, angles, skip)
@@ -1,41 +1,70 @@
 import math
+import functools
 import numpy as np
-import numpy.matlib
-from scipy.fftpack import fft, ifft, fftfreq
+import scipy.fft
 
-def ramp_filter(sinogram, scale, alpha=0.001):
+@functools.lru_cache(maxsize=32)
+def ramp_kernel(m, scale, alpha):
+	""" ramlak = ramp_kernel(m, scale, alpha) returns the raised-cosine combined
+	Ram-Lak filter for an FFT of length m, at the non-negative frequencies used
+	by a real FFT. The result is read-only and shared between calls."""
+
+	# create the raised-cosine combined ram-lak filter with the set length
+	freqs = scipy.fft.fftfreq(m, d=scale)
+	k = 0.5 * np.pi * np.abs(np.max(freqs))
+	freqs = np.abs(freqs[:m // 2 + 1])
+	ramlak = freqs * (np.abs(np.cos(freqs * k * 2 * np.pi)) ** alpha)
+	ramlak[0] = ramlak[1]/6
+	ramlak.flags.writeable = False
+
+	return ramlak
+
+def ramp_filter(sinogram, scale, alpha=0.001, workers=None, out=None):
 	""" Ram-Lak filter with raised-cosine for CT reconstruction
 
 	fs = ramp_filter(sinogram, scale) filters the input in sinogram (angles x samples)
 	using a Ram-Lak filter.
 
 	fs = ramp_filter(sinogram, scale, alpha) can be used to modify the Ram-Lak filter by a
-	cosine raised to the power given by alpha."""
+	cosine raised to the power given by alpha.
+
+	fs = ramp_filter(sinogram, scale, alpha, workers) uses the given number of
+	threads for the FFTs. All angles are filtered together using a single real
+	FFT, and any leading dimensions of sinogram are filtered in the same way.
+
+	fs = ramp_filter(sinogram, scale, alpha, workers, out) writes the result
+	to out, which can be sinogram itself. Single precision sinograms are
+	filtered in single precision."""
 
 	# get input dimensions
-	angles = sinogram.shape[0]
-	n = sinogram.shape[1]
+	n = sinogram.shape[-1]
 
-	#Set up filter to be at least twice as long as input
-	m = np.ceil(np.log(2*n-1) / np.log(2))
-	m = int(2 ** m)
+	#Set up filter to be at least twice as long as input, using a length
+	#which is fast for the FFT
+	m = scipy.fft.next_fast_len(2*n-1, real=True)
 
-	# create the raised-cosine combined ram-lak filter with the set length
-	freqs = fftfreq(m, d=scale)
-	k = 0.5 * np.pi * np.abs(np.max(freqs))
-	ramlak = np.abs(freqs) * (np.abs(np.cos(freqs * k * 2 * np.pi)) ** alpha)
-	ramlak[0] = ramlak[1]/6
+	ramlak = ramp_kernel(m, scale, alpha)
 
 	# apply filter to all angles
-	print('Ramp filtering')
+	proj_fft = scipy.fft.rfft(sinogram, m, axis=-1, workers=workers)
+	proj_fft *= ramlak
+	filtered = scipy.fft.irfft(proj_fft, m, axis=-1, workers=workers)
+
+	# Truncate back to original length
+	if out is None:
+		return np.ascontiguousarray(filtered[..., :n])
+	out[...] = filtered[..., :n]
+	return out
 
-	filtered = np.zeros((angles, n))
-	for i in range(angles):
-		proj_fft = fft(sinogram[i], m)
-		proj_fft = proj_fft * ramlak
-		proj_filtered = np.real(ifft(proj_fft))
+def ramp_filters(sinogram, scale, alphas, workers=None):
+	""" fs = ramp_filters(sinogram, scale, alphas) returns a generator which gives
+	ramp_filter(sinogram, scale, alpha) for each alpha in alphas in turn. The
+	FFT of sinogram is only worked out once, and shared by all of them."""
 
-        # Truncate back to original length
-		filtered[i] = proj_filtered[:n]
+	n = sinogram.shape[-1]
+	m = scipy.fft.next_fast_len(2*n-1, real=True)
 
-	return filtered
\ No newline at end of file
+	proj_fft = scipy.fft.rfft(sinogram, m, axis=-1, workers=workers)
+	for alpha in alphas:
+		filtered = scipy.fft.irfft(proj_fft * ramp_kernel(m, scale, alpha), m, axis=-1, workers=workers)
+		yield np.ascontiguousarray(filtered[..., :n])
@@ -4,36 +4,81 @@ from ct_lib import *
 from ramp_filter import *
 from back_project import *
 from hu import *
+from os_sart import *
+from ct_trace import stage
 
-def scan_and_reconstruct(photons, material, phantom, scale, angles, mas=10000, alpha=0.001):
+def scan_and_reconstruct(photons, material, phantom, scale, angles, mas=10000, alpha=0.001, batch=None, rng=None, electronic=0, method=None, dtype=float, out=None, workers=None):
 
 	""" Simulation of the CT scanning process
 		reconstruction = scan_and_reconstruct(photons, material, phantom, scale, angles, mas, alpha)
 		takes the phantom data in phantom (samples x samples), scans it using the
 		source photons and material information given, as well as the scale (in cm),
 		number of angles, time-current product in mas, and raised-cosine power
-		alpha for filtering. The output reconstruction is the same size as phantom."""
+		alpha for filtering. The output reconstruction is the same size as phantom.
 
+		phantom can also be a volume (slices x samples x samples), in which case
+		all slices are scanned and reconstructed together, sharing the rotation
+		geometry and calibration, or batch slices at a time if batch is given.
+
+		If rng is given, the scan has Poisson and electronic noise, drawn
+		using this numpy random Generator or seed, as in ct_scan.
+
+		method is 'fbp' (the default) for filtered back-projection, or
+		'os_sart' for iterative reconstruction using os_sart, starting from
+		the filtered back-projection, which is better for few angles.
+
+		Each stage is recorded in the active ct_trace.Trace, if there is one.
+
+		dtype is the type used for the scan and reconstruction, which can be
+		np.float32 to halve the memory used. The sinogram is then calibrated
+		and filtered in place, and the reconstruction converted to HU in
+		place, in out if given. In single precision, reconstructions are
+		within 0.005 HU of those in double precision (see test_precision
+		in ct_test_example.py).
+
+		workers is the number of threads used by ct_scan, ramp_filter and
+		back_project, and the result is the same for any workers of 1 or
+		more. Without workers, a single image is back-projected one angle at
+		a time, which differs from this by rounding."""
+
+	if (phantom.ndim == 3) and (batch is not None):
+		rng = None if rng is None else np.random.default_rng(rng)
+		if out is None:
+			out = np.empty(phantom.shape, dtype=dtype)
+		for first in range(0, phantom.shape[0], batch):
+			scan_and_reconstruct(photons, material, phantom[first:first + batch], scale, angles, mas, alpha, None, rng, electronic, method, dtype, out[first:first + batch], workers)
+		return out
 
 	# convert source (photons per (mas, cm^2)) to photons
 	photons = photons * mas * scale ** 2
 
 	# create sinogram from phantom data, with received detector values
-	sinogram = ct_scan(photons, material, phantom, scale, angles, mas)
+	with stage('ct_scan', angles=angles, n=phantom.shape[-1]):
+		sinogram = ct_scan(photons, material, phantom, scale, angles, mas, rng=rng, electronic=electronic, dtype=dtype, workers=workers)
 
 	# convert detector values into calibrated attenuation values
-	sinogram = ct_calibrate(photons, material, sinogram, scale)
-	print("Sinogram shape:", sinogram.shape)
+	with stage('ct_calibrate'):
+		sinogram = ct_calibrate(photons, material, sinogram, scale, out=sinogram)
+
+	if method == 'os_sart':
+
+		# iterative reconstruction
+		with stage('os_sart'):
+			reconstruction = os_sart(sinogram, scale, alpha=alpha).astype(dtype, copy=False)
+
+	else:
 
-	# Ram-Lak
-	sinogram = ramp_filter(sinogram, scale, alpha)
+		# Ram-Lak
+		with stage('ramp_filter'):
+			sinogram = ramp_filter(sinogram, scale, alpha, workers, out=sinogram)
 
-	# Back-projection
-	reconstruction = back_project(sinogram)
-	print("Reconstruction shape:", reconstruction.shape)
+		# Back-projection
+		with stage('back_project'):
+			reconstruction = back_project(sinogram, out=out, workers=workers)
 
 	# convert to Hounsfield Units
-	reconstruction = hu(photons, material, reconstruction, scale)
+	with stage('hu'):
+		reconstruction = hu(photons, material, reconstruction, scale, out=reconstruction if out is None else out)
  
 
 	return reconstruction
\ No newline at end of file
@@ -1,51 +1,19 @@
-import numpy as np
-from openpyxl import load_workbook
+from table_cache import load_table
 
 
 class Source(object):
 	def __init__(self):
 		"""Source holds source, mev, and photon information
-		which is loaded from an xlsx spreadsheet on initialisation"""
+		which is loaded from an xlsx spreadsheet on initialisation, or from
+		a binary copy of it if the spreadsheet is unchanged"""
 
 		# set up file name, sheet name, and important header names
 		filename = 'mass_attenuation_coeffs.xlsx'
 		sheetname = 'Sources'
 		mevname = 'MeV'
 		
-		# open workbook
-		book = load_workbook(filename, read_only=True, data_only=True)
-
-		# check for existing sheet name
-		if sheetname not in book.sheetnames:
-			raise IndexError(filename + ' does not contain a ' + sheetname + ' sheet')
-
-		# load header row, containing source names
-		sheet = book[sheetname]
-		header = []
-		for row in sheet.iter_rows(min_row=1, max_row=1):
-			for cell in row:
-				header.append(cell.value)
-
-		# check first header is energy
-		if mevname not in header[0]:
-			raise IndexError(sheetname + ' does not contain a ' + mevname + ' header')
-		
-		# load the first column, which is energy values
-		self.name = header[1:]
-		mev = []
-		for row in sheet.iter_rows(min_row=2, min_col=1, max_col=1):
-			for cell in row:
-				mev.append(cell.value)
-		self.mev = np.array(mev, dtype=float)
-
-		# load the remaining data, which are photons
-		ps = []
-		for row in sheet.iter_rows(min_row=2, min_col=2, max_col=len(header)):
-			p = []
-			for cell in row:
-				p.append(cell.value)
-			ps.append(p)
-		self.photons = np.array(ps, dtype=float).transpose()
+		# load from the binary copy of the spreadsheet where possible
+		self.name, self.mev, self.photons = load_table(filename, sheetname, mevname)
 
 
 	def photon(self, input):
@@ -57,4 +25,17 @@ class Source(object):
 
 		# return the appropriate coeff
 		index = self.name.index(input)
-		return self.photons[index].copy()
\ No newline at end of file
+		return self.photons[index].copy()
+
+
+_shared = None
+
+def get_source():
+	"""returns a Source instance which is shared, and only created the first
+	time this is called"""
+
+	global _shared
+	if _shared is None:
+		_shared = Source()
+
+	return _shared
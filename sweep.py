@@ -0,0 +1,80 @@
+from ct_scan import *
+from ct_detect import *
+from ct_noise import *
+from calibration import *
+from ramp_filter import *
+from back_project import *
+from hu import *
+from ct_trace import stage
+
+def sweep(sources, material, phantom, scale, angles, mas=10000, alpha=0.001, rng=None, electronic=0):
+
+	""" Simulation of the CT scanning process over a grid of parameters
+		results = sweep(sources, material, phantom, scale, angles, mas, alpha)
+		returns a generator which gives ((source, mas, alpha, angles),
+		reconstruction) for every combination of the given sources, mas,
+		alpha and angles, where reconstruction is the same as from
+		scan_and_reconstruct with those parameters. sources is a dictionary
+		of source photons by name, or a list of them, in which case source is
+		the index in the list, and mas, alpha and angles can each be a single
+		value or a list of values. Use dict(sweep(...)) to keep them all.
+
+		Each stage is only worked out once for each combination of the
+		parameters it depends on, and shared by all of the stages after it:
+		the material depths along each ray depend only on angles, the
+		detections only on the source (and scale linearly with mas), the
+		calibration on the source and mas, and the filtering on alpha, where
+		a single FFT of each sinogram is used for all alpha.
+
+		If rng is given, the scans have Poisson and electronic noise, drawn
+		using this numpy random Generator or seed, as in ct_scan."""
+
+	if not isinstance(sources, dict):
+		sources = dict(enumerate(sources))
+	mas = np.atleast_1d(mas)
+	alpha = np.atleast_1d(alpha)
+	angles = np.atleast_1d(angles)
+	if rng is not None:
+		rng = np.random.default_rng(rng)
+	n = phantom.shape[-1]
+
+	for a in angles:
+
+		# the material depths do not depend on the source
+		with stage('ct_depth', angles=int(a)):
+			depth, materials = ct_depth(material, phantom, scale, int(a))
+		coeffs = material.coeffs[materials]
+
+		for name, photons in sources.items():
+
+			# detections for the largest mas, which are scaled to give the others
+			# before the minimum of one photon is applied
+			photons = photons * scale ** 2
+			largest = np.max(mas)
+			with stage('ct_detect', source=str(name)):
+				expected = ct_detect(photons * largest, coeffs, depth.reshape((len(materials), -1)))
+			expected = expected.reshape(depth.shape[1:])
+			if phantom.ndim != 3:
+				expected = expected[0]
+
+			for m in mas:
+
+				# convert source (photons per (mas, cm^2)) to photons
+				p = photons * m
+				scan = np.clip(expected * (m / largest), 1, None)
+				scan = scan_noise(scan, rng, electronic)
+
+				# convert detector values into calibrated attenuation values
+				with stage('ct_calibrate', mas=float(m)):
+					calibration = get_calibration(p, material, scale, n)
+					sinogram = calibration.apply(scan)
+
+				for al, filtered in zip(alpha, ramp_filters(sinogram, scale, alpha)):
+
+					# back-projection, and convert to Hounsfield Units
+					with stage('back_project', alpha=float(al)):
+						reconstruction = back_project(filtered)
+					with stage('hu'):
+						reconstruction = hu(p, material, reconstruction, scale)
+
+					yield (name, m, al, a), reconstruction
@@ -0,0 +1,74 @@
+import numpy as np
+import os
+from openpyxl import load_workbook
+
+def table_path(filename):
+	"""returns the full path of filename, looking in the current directory
+	and then alongside these modules"""
+
+	if os.path.isfile(filename):
+		return os.path.abspath(filename)
+
+	return os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+
+def read_table(filename, sheetname, mevname):
+	""" name, mev, values = read_table(filename, sheetname, mevname) reads the
+	given sheet from the xlsx spreadsheet filename. The header row contains
+	the mevname header followed by the names, the first column contains the
+	energies in mev, and the remaining columns are returned in values
+	(names x energies)."""
+
+	# open workbook
+	book = load_workbook(filename, read_only=True, data_only=True)
+
+	# check for existing sheet name
+	if sheetname not in book.sheetnames:
+		raise IndexError(filename + ' does not contain a ' + sheetname + ' sheet')
+
+	# load all rows at once, the header row contains the names
+	sheet = book[sheetname]
+	rows = list(sheet.iter_rows(values_only=True))
+	header = list(rows[0])
+
+	# check first header is energy
+	if mevname not in header[0]:
+		raise IndexError(sheetname + ' does not contain a ' + mevname + ' header')
+
+	# the first column is energy values, and the remainder are the values
+	data = np.array([row[:len(header)] for row in rows[1:]], dtype=float)
+	book.close()
+
+	return header[1:], data[:, 0].copy(), data[:, 1:].transpose().copy()
+
+def load_table(filename, sheetname, mevname):
+	""" name, mev, values = load_table(filename, sheetname, mevname) is the same
+	as read_table, but keeps a binary copy of the sheet in a .npz file next to
+	the spreadsheet, and uses this instead whenever the spreadsheet has not
+	been modified since. If the copy cannot be written, the spreadsheet is
+	just read each time."""
+
+	filename = table_path(filename)
+	stat = os.stat(filename)
+	stamp = np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+	cachename = os.path.splitext(filename)[0] + '.' + sheetname + '.npz'
+
+	# use the binary copy if it is from the same version of the spreadsheet
+	try:
+		with np.load(cachename, allow_pickle=False) as cache:
+			if np.array_equal(cache['stamp'], stamp):
+				return [str(n) for n in cache['name']], cache['mev'], cache['values']
+	except (OSError, KeyError, ValueError):
+		pass
+
+	name, mev, values = read_table(filename, sheetname, mevname)
+
+	# write to a temporary file first, so other processes never see part of it
+	try:
+		temporary = cachename + '.' + str(os.getpid()) + '.tmp'
+		with open(temporary, 'wb') as f:
+			np.savez(f, stamp=stamp, name=np.array(name, dtype=str), mev=mev, values=values)
+		os.replace(temporary, cachename)
+	except OSError:
+		pass
+
+	return name, mev, values
@@ -1,12 +1,13 @@
 import numpy as np
-import scipy
-from scipy import ndimage
 import math
 import os
-import sys
+import collections
+import concurrent.futures
 from ramp_filter import *
 from back_project import *
 from create_dicom import *
+from projector import interpolation_weights
+from ct_trace import stage, progress, current, traced
 
 class Xtreme(object):
     def __init__(self, file):
@@ -41,6 +42,9 @@ class Xtreme(object):
         'filename' - name of file"""
 
         self.okay = True
+        self._data = None
+        self._rebin_coordinates = None
+        self._rebin_weights = None
 
         if not os.path.isfile(file):
             self.okay = False
@@ -99,6 +103,47 @@ class Xtreme(object):
 
             f.close()
 
+    def rsq_data(self):
+
+        """ D = rsq_data() returns the raw int16 data in the file as a
+        read-only memory-mapped array D of size (scans x angles+2 x
+        samples+skip_samples). For each scan, the first row is Ymin, the
+        second row is Ymax and the remaining rows are the angles, and each
+        row has left_samples invalid samples at the start and right_samples
+        at the end. The file is only mapped once, and no data is read until
+        it is used. A ValueError is raised if the file is shorter than its
+        header says."""
+
+        if not self.okay:
+            print('File not opened correctly')
+            return
+
+        if self._data is None:
+            offset = (int(self.data_offset)+1)*512
+            shape = (int(self.scans), int(self.angles)+2, int(self.samples+self.skip_samples))
+            size = offset + int(np.prod(shape)) * np.dtype(np.int16).itemsize
+            if os.path.getsize(self.filename) < size:
+                raise ValueError('File is truncated: header needs %d bytes but file has %d' % (size, os.path.getsize(self.filename)))
+            self._data = np.memmap(self.filename, np.int16, 'r', offset=offset, shape=shape)
+
+        return self._data
+
+    def rsq_views(self):
+
+        """ [Y, Ymin, Ymax] = rsq_views() returns strided views of the valid
+        samples in the memory-mapped file, without reading or copying any
+        data. Y is of size (scans x angles x samples), and Ymin and Ymax are
+        of size (scans x samples). Indexing Y[scan] gives a fan-based
+        sinogram, and Y[:, angle] an X-ray at that angle."""
+
+        data = self.rsq_data()
+        if data is None:
+            return
+
+        samples = data[:, :, self.left_samples:self.left_samples+self.samples]
+
+        return samples[:, 2:], samples[:, 0], samples[:, 1]
+
     def get_rsq_scan(self, angle):
 
         """ [Y, Ymin, Ymax] = get_rsq_scan( A ) reads in angle A from the file.
@@ -117,31 +162,10 @@ class Xtreme(object):
             print('Angle is not within range')
             return
 
-        # open file and get to start of data
-        f = open(self.filename, 'rb')
-        f.seek((self.data_offset+1)*512,0)
-
-        # loop through scans, selecting appropriate angle, and all calibration data
-        Y = np.zeros([self.scans, self.samples])
-        Ymin = np.zeros([self.scans, self.samples])
-        Ymax = np.zeros([self.scans, self.samples])
-        for scan in range(0, self.scans):
-            f.seek(self.left_samples*2, 1)
-            b = f.read(2*self.samples)
-            Ymin[scan] = np.frombuffer(b, np.int16, self.samples)
-            f.seek(self.skip_samples*2, 1)
-            b = f.read(2*self.samples)
-            Ymax[scan] = np.frombuffer(b, np.int16, self.samples)
-            f.seek((self.samples+self.skip_samples)*angle*2, 1)
-            f.seek(self.skip_samples*2, 1)
-            b = f.read(2*self.samples)
-            Y[scan] = np.frombuffer(b, np.int16, self.samples)
-            f.seek(self.right_samples*2, 1)
-            f.seek((self.samples+self.skip_samples)*(self.angles-angle-1)*2, 1)
-
-        f.close()
-
-        return Y, Ymin, Ymax
+        # select the appropriate angle, and all calibration data
+        Y, Ymin, Ymax = self.rsq_views()
+
+        return np.array(Y[:, angle], dtype=float), np.array(Ymin, dtype=float), np.array(Ymax, dtype=float)
 
     def get_rsq_slice(self, scan):
 
@@ -160,85 +184,346 @@ class Xtreme(object):
             print('Scan is not within range')
             return
 
-        # open file and get to start of data
-        f = open(self.filename, 'rb')
-        f.seek((self.data_offset+1)*512,0)
+        # select the requested slice and its calibration data
+        Y, Ymin, Ymax = self.rsq_views()
+
+        return np.array(Y[scan], dtype=float), np.array(Ymin[scan]), np.array(Ymax[scan])
+
+    def rebin_coordinates(self):
+
+        """ [yo, xo] = rebin_coordinates() returns the angle yo and sample xo
+        in the raw sinogram (angles x samples) which correspond to each point
+        of the parallel-beam sinogram (recon_angles x samples). These only
+        depend on the header, so are worked out once and kept."""
+
+        if self._rebin_coordinates is None:
+
+            # calculate some required parameters
+            angles = self.recon_angles
+            samples = self.samples
+            atheta = self.fan_theta*0.172# about 1/6 of the fan angle
+            c = self.samples/2 - 0.5   # the centre sample
+
+            # form output coordinates - y0 is zero-based at this point
+            xo1, yo1 = np.meshgrid(np.arange(samples), np.arange(angles))
+            yo = np.arcsin((xo1-c)/self.radius)
 
-        # Advance to requested slice
-        f.seek((self.samples+self.skip_samples)*(self.angles+2)*2*scan, 1)
+            # n1, n2 and n3 signify samples on one of three separate detector arrays,
+            # each occupying one-third of the fan angle
+            xo = np.zeros((angles, samples))
+            index = yo>atheta
+            xo[index] = (xo1[index]-(5.0*samples/6.0))/np.cos(yo[index]-2.0*atheta) + c + samples/3.0
+            index = yo<-atheta
+            xo[index] = (xo1[index]-(samples/6.0))/np.cos(yo[index]+2.0*atheta) + c - samples/3.0
+            index = np.logical_and(yo<=atheta, yo>=-atheta)
+            xo[index] = (xo1[index]-(samples/2.0))/np.cos(yo[index]) + c
 
-        # read in calibration data
-        f.seek(self.left_samples*2, 1)
-        b = f.read(self.samples*2)
-        Ymin = np.frombuffer(b, np.int16, self.samples)
-        f.seek(self.skip_samples*2, 1)
-        b = f.read(self.samples*2)
-        Ymax = np.frombuffer(b, np.int16, self.samples)
+            # adjust angle so it is not zero-based
+            yo = yo/self.dtheta + yo1 + self.skip_angles/2.0 + self.fan_angles/2.0 - 0.5
 
-        # loop to read scan
-        Y = np.zeros([self.angles, self.samples])
-        for angle in range(0, self.angles):
-            f.seek(self.skip_samples*2, 1)
-            b = f.read(2*self.samples)
-            Y[angle] = np.frombuffer(b, np.int16, self.samples)
+            self._rebin_coordinates = (yo, xo)
 
-        f.close()
+        return self._rebin_coordinates
 
-        return Y, Ymin, Ymax
+    def rebin_weights(self):
+
+        """ [index, weight] = rebin_weights() returns the flat indices into the
+        raw sinogram, and the weights, of the four neighbours used to
+        linearly interpolate each point of the parallel-beam sinogram, each
+        of size (4 x recon_angles x samples). These are worked out once and
+        kept."""
+
+        if self._rebin_weights is None:
+            yo, xo = self.rebin_coordinates()
+            self._rebin_weights = interpolation_weights([yo, xo], (self.angles, self.samples))
+
+        return self._rebin_weights
 
     def fan_to_parallel(self, X):
 
         """ Y = fan_to_parallel( X ) takes the raw sinogram in X (angles x
         samples) and converts this to an equivalent parallel-beam sinogram
-        in Y (recon_angles x samples)."""
+        in Y (recon_angles x samples).
 
-        print('Fan to parallel sinogram')
-        
-        # calculate some required parameters
-        angles = self.recon_angles
+        X can also be a stack of sinograms (slices x angles x samples), which
+        are all converted at once into Y (slices x recon_angles x samples).
+        The interpolation uses the same precomputed weights for every call."""
+
+        if X.shape[-2:] != (self.angles, self.samples):
+            raise ValueError('input X has different size to the raw sinogram')
+
+        index, weight = self.rebin_weights()
+
+        # actually perform the interpolation, for every slice at once
+        shape = X.shape[:-2] + weight.shape[1:]
+        X = np.asarray(X, dtype=float).reshape((-1, self.angles * self.samples))
+        Y = X[:, index[0]] * weight[0]
+        for k in range(1, len(index)):
+            Y += X[:, index[k]] * weight[k]
+
+        return Y.reshape(shape)
+
+    def calibrate(self, Y, Ymin, Ymax):
+
+        """ X = calibrate( Y, Ymin, Ymax ) converts the raw detections in Y
+        to attenuation, using the detections with no X-ray source in Ymin
+        and with no object in the scanner in Ymax. There is always at least
+        one detection, to avoid taking the logarithm of zero. The raw int16
+        detections are converted to float first, so the differences cannot
+        wrap around."""
+
+        Y = np.asarray(Y, dtype=float)
+        Ymin = np.asarray(Ymin, dtype=float)
+        Ymax = np.asarray(Ymax, dtype=float)
+
+        return -np.log(np.clip(Y - Ymin, 1, None) / np.clip(Ymax - Ymin, 1, None))
+
+    def reconstruct_slice(self, scan, alpha=0.001, mu_water=0.02, method=None):
+
+        """ X = reconstruct_slice( F, ALPHA, MU_WATER ) reconstructs slice F
+        using a fan to parallel conversion, and returns it in Hounsfield
+        units in X (samples x samples). ALPHA is the power of the raised
+        cosine function used to filter the data, and MU_WATER is the linear
+        attenuation coefficient of water, per mm.
+
+        X = reconstruct_slice( F, ALPHA, MU_WATER, 'fan' ) instead uses
+        fan_reconstruct_slice, without the conversion to parallel beams."""
+
+        if method == 'fan':
+            return self.fan_reconstruct_slice(scan, alpha, mu_water)
+
+        with stage('read', scan=scan):
+            Y, Ymin, Ymax = self.get_rsq_slice(scan)
+            Y = self.calibrate(Y, Ymin, Ymax)
+        with stage('fan_to_parallel'):
+            Y = self.fan_to_parallel(Y)
+        with stage('ramp_filter'):
+            Y = ramp_filter(Y, self.scale, alpha)
+        with stage('back_project'):
+            X = back_project(Y)
+
+        return ((X - mu_water) / mu_water) * 1000
+
+    def reconstruct_slices(self, scans, alpha=0.001, mu_water=0.02, workers=None, method=None):
+
+        """ reconstruct_slices( SCANS, ALPHA, MU_WATER, WORKERS, METHOD )
+        returns a generator which reconstructs each slice in SCANS, as in
+        reconstruct_slice, using a pool of WORKERS processes (all processors
+        if not given). The slices are returned in order, and at most two per
+        worker are in progress at once, so memory use is bounded.
+
+        If a Trace is active, the stages of each slice are traced in the
+        worker processes and merged into it as each slice is returned, but
+        progress within each slice is only reported with one worker."""
+
+        if workers is None:
+            workers = os.cpu_count()
+
+        if workers <= 1:
+            for scan in scans:
+                yield self.reconstruct_slice(scan, alpha, mu_water, method)
+            return
+
+        trace = current()
+        memory = None if trace is None else trace.memory
+
+        def result(future):
+            X, records = future.result()
+            if trace is not None:
+                trace.merge(records)
+            return X
+
+        with concurrent.futures.ProcessPoolExecutor(workers, initializer=_open_worker, initargs=(self.filename,)) as pool:
+            pending = collections.deque()
+            for scan in scans:
+                pending.append(pool.submit(_reconstruct_slice, scan, alpha, mu_water, method, memory))
+                if len(pending) >= 2 * workers:
+                    yield result(pending.popleft())
+            while pending:
+                yield result(pending.popleft())
+
+    def detector_position(self, gamma):
+
+        """ X = detector_position( G ) returns the (fractional) sample X on
+        the three detector arrays which measures the ray at fan angle G, in
+        radians from the central ray. This is the same mapping as is used
+        by fan_to_parallel."""
+
+        gamma = np.asarray(gamma, dtype=float)
         samples = self.samples
         atheta = self.fan_theta*0.172# about 1/6 of the fan angle
         c = self.samples/2 - 0.5   # the centre sample
-
-        # form output coordinates - y0 is zero-based at this point
-        xo1, yo1 = np.meshgrid(np.arange(samples), np.arange(angles))
-        #xo1 = np.zeros([angles, samples])
-        #for index, value in np.ndenumerate(xo1):
-        #    xo1[index] = index[1]
-        #yo1 = np.zeros([angles, samples])
-        #for index, value in np.ndenumerate(yo1):
-        #    yo1[index] = index[0]
-        yo = np.arcsin((xo1-c)/self.radius)
+        xo1 = self.radius*np.sin(gamma) + c
 
         # n1, n2 and n3 signify samples on one of three separate detector arrays,
         # each occupying one-third of the fan angle
-        xo = np.zeros((angles, samples))
-        #for index, y in np.ndenumerate(yo):
-        #    if y>atheta:
-        #        xo[index] = (xo1[index]-(5.0*samples/6.0))/np.cos(y-2.0*atheta) + c + samples/3.0
-        #    elif y<-atheta:
-        #        xo[index] = (xo1[index]-(samples/6.0))/np.cos(y+2.0*atheta) + c - samples/3.0
-        #    else:
-        #        xo[index] = (xo1[index]-(samples/2.0))/np.cos(y) + c
-        index = yo>atheta
-        xo[index] = (xo1[index]-(5.0*samples/6.0))/np.cos(yo[index]-2.0*atheta) + c + samples/3.0
-        index = yo<-atheta
-        xo[index] = (xo1[index]-(samples/6.0))/np.cos(yo[index]+2.0*atheta) + c - samples/3.0
-        index = np.logical_and(yo<=atheta, yo>=-atheta)
-        xo[index] = (xo1[index]-(samples/2.0))/np.cos(yo[index]) + c
+        return np.where(gamma>atheta, (xo1-(5.0*samples/6.0))/np.cos(gamma-2.0*atheta) + c + samples/3.0,
+            np.where(gamma<-atheta, (xo1-(samples/6.0))/np.cos(gamma+2.0*atheta) + c - samples/3.0,
+            (xo1-(samples/2.0))/np.cos(gamma) + c))
+
+    def short_scan_weights(self, beta, gamma):
+
+        """ W = short_scan_weights( B, G ) returns the Parker weights W for
+        rays at fan angle G from the source angle B, where B runs from 0 to
+        pi plus the fan angle. The weights of each ray and the opposite ray
+        through the same line sum to one."""
+
+        # with angles measured this way, the opposite ray is at fan angle -G
+        # and source angle B + pi - 2G
+        delta = self.fan_theta / 2.0
+        g = -np.asarray(gamma, dtype=float)
+        beta = np.asarray(beta, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rise = np.sin(np.pi / 4 * beta / (delta - g)) ** 2
+            fall = np.sin(np.pi / 4 * (np.pi + 2 * delta - beta) / (delta + g)) ** 2
+
+        return np.where(beta < 2 * delta - 2 * g, rise, np.where(beta > np.pi - 2 * g, fall, 1.0))
+
+    def filter_fan(self, P, beta, v, alpha=0.001):
+
+        """ Q = filter_fan( P, B, V, ALPHA ) takes calibrated fan-beam
+        projections P (angles x rows x samples) from source angles B, with
+        detector rows V from the centre of the cone, and returns them
+        filtered for back-projection in Q.
+
+        Each projection is resampled onto a virtual flat detector through
+        the centre of rotation, which has the same sample spacing and covers
+        the same fan angle, weighted by the cosine of the ray angle and the
+        short-scan Parker weights, and ramp filtered along each row."""
+
+        samples = self.samples
+        c = samples/2 - 0.5   # the centre sample
+        radius = self.radius
+
+        u = np.arange(samples) - c
+        gamma = np.arctan(u / radius)
+        index, weight = interpolation_weights([self.detector_position(gamma)], (samples,))
+        P = P[..., index[0]] * weight[0] + P[..., index[1]] * weight[1]
 
-        # adjust angle so it is not zero-based
-        yo = yo/self.dtheta + yo1 + self.skip_angles/2.0 + self.fan_angles/2.0 - 0.5
+        v = np.asarray(v, dtype=float)[:, np.newaxis]
+        P *= radius / np.sqrt(radius ** 2 + u ** 2 + v ** 2)
+        P *= self.short_scan_weights(beta[:, np.newaxis], gamma)[:, np.newaxis, :]
 
-        # actually perform the interpolation
-        Y = scipy.ndimage.map_coordinates(X, [yo, xo], None, 1, 'constant', 0, False)
+        return ramp_filter(P, self.scale, alpha)
 
-        return Y
+    def fan_geometry(self, beta, xi, yi):
 
+        """ [U, M] = fan_geometry( B, XI, YI ) returns the sample U on the
+        virtual flat detector of filter_fan through each pixel at (XI, YI),
+        for the source at angle B, together with the magnification M of
+        that pixel from the centre of rotation to the detector."""
 
+        # source angle relative to the central ray of the z-fan, as used
+        # by fan_to_parallel, and the position of each voxel relative to
+        # the source, across and along the central ray
+        b = beta - self.fan_theta / 2.0
+        across = -xi * math.sin(b) - yi * math.cos(b)
+        along = xi * math.cos(b) - yi * math.sin(b)
+        magnification = self.radius / (self.radius - along)
 
+        return across * magnification + self.samples/2 - 0.5, magnification
 
-    def reconstruct_all(self, file, method=None, alpha=None):
+    def fan_reconstruct_slice(self, scan, alpha=0.001, mu_water=0.02):
+
+        """ X = fan_reconstruct_slice( F, ALPHA, MU_WATER ) reconstructs
+        slice F directly from the fan-beam sinogram, without first
+        converting to parallel beams, and returns it in Hounsfield units in
+        X (samples x samples). ALPHA is the power of the raised cosine
+        function used to filter the data, and MU_WATER is the linear
+        attenuation coefficient of water, per mm.
+
+        The angles over pi plus the fan angle are filtered as in filter_fan,
+        and each is back-projected along the fan of rays from the source,
+        weighted by the inverse square distance from the source."""
+
+        samples = self.samples
+
+        # angles covering pi plus the fan angle
+        angles = np.arange(self.skip_angles//2, self.skip_angles//2 + self.recon_angles + self.fan_angles)
+        beta = (angles - self.skip_angles/2.0 + 0.5) * self.dtheta
+
+        Y, Ymin, Ymax = self.rsq_views()
+        P = self.calibrate(np.array(Y[scan, angles[0]:angles[-1]+1], dtype=float), Ymin[scan], Ymax[scan])
+        P = self.filter_fan(P[:, np.newaxis, :], beta, [0], alpha)[:, 0]
+
+        xi = (np.arange(samples) - (samples/2) + 0.5)[np.newaxis, :]
+        yi = (np.arange(samples) - (samples/2) + 0.5)[:, np.newaxis]
+        X = np.zeros((samples, samples))
+
+        for a in range(len(angles)):
+            u, magnification = self.fan_geometry(beta[a], xi, yi)
+            iu, wu = interpolation_weights([u], (samples,))
+            X += (P[a, iu[0]] * wu[0] + P[a, iu[1]] * wu[1]) * (magnification ** 2 * self.dtheta)
+
+        # ensure any data outside the reconstructed circle is set to invalid
+        X[(xi ** 2 + yi ** 2) > (samples/2)**2] = -1
+
+        return ((X - mu_water) / mu_water) * 1000
+
+    def reconstruct_fan(self, fan, alpha=0.001, mu_water=0.02):
+
+        """ X = reconstruct_fan( F, ALPHA, MU_WATER ) reconstructs the valid
+        slices of the z-fan starting at scan F together, using an
+        approximate FDK (Feldkamp-Davis-Kress) cone-beam algorithm, and
+        returns them in Hounsfield units in X (slices x samples x samples).
+        ALPHA is the power of the raised cosine function used to filter the
+        data, and MU_WATER is the linear attenuation coefficient of water,
+        per mm.
+
+        Each projection over pi plus the fan angle is filtered as in
+        filter_fan, and then back-projected into the whole volume,
+        following the tilted ray through each voxel to its detector row."""
+
+        samples = self.samples
+
+        # detector rows in this z-fan, angles covering pi plus the fan angle,
+        # and the slices which are reconstructed
+        rows = np.arange(fan, min(fan + self.fan_scans, self.scans))
+        angles = np.arange(self.skip_angles//2, self.skip_angles//2 + self.recon_angles + self.fan_angles)
+        slices = np.arange(fan + self.skip_scans, min(fan + self.fan_scans - self.skip_scans, self.scans))
+        zc = (self.fan_scans - 1) / 2.0   # the centre row of the cone
+
+        # read and calibrate the data, as (angles x rows x samples)
+        Y, Ymin, Ymax = self.rsq_views()
+        P = self.calibrate(np.array(Y[rows[0]:rows[-1]+1, angles[0]:angles[-1]+1], dtype=float),
+            Ymin[rows[0]:rows[-1]+1, np.newaxis], Ymax[rows[0]:rows[-1]+1, np.newaxis])
+        P = P.transpose((1, 0, 2))
+
+        # resample, weight and filter along each detector row
+        beta = (angles - self.skip_angles/2.0 + 0.5) * self.dtheta
+        P = self.filter_fan(P, beta, rows - fan - zc, alpha)
+        P = P.reshape((len(angles), -1))
+
+        # voxel coordinates, with centre in the middle of each slice
+        xi = (np.arange(samples) - (samples/2) + 0.5)[np.newaxis, :]
+        yi = (np.arange(samples) - (samples/2) + 0.5)[:, np.newaxis]
+        z = (slices - fan)[:, np.newaxis, np.newaxis]
+        X = np.zeros((len(slices), samples, samples))
+
+        for a in range(len(angles)):
+            # detector sample and row through each voxel
+            u, magnification = self.fan_geometry(beta[a], xi, yi)
+            iu, wu = interpolation_weights([u], (samples,))
+            rv = np.clip((z - zc) * magnification + zc, 0, len(rows) - 1)
+            lower = np.floor(rv)
+            fraction = rv - lower
+            lower = lower.astype(np.intp)
+            upper = np.minimum(lower + 1, len(rows) - 1)
+
+            # interpolate, and weight by the inverse square distance from the source
+            Pa = P[a]
+            near = Pa[lower * samples + iu[0]] * wu[0] + Pa[lower * samples + iu[1]] * wu[1]
+            far = Pa[upper * samples + iu[0]] * wu[0] + Pa[upper * samples + iu[1]] * wu[1]
+            X += (near + (far - near) * fraction) * (magnification ** 2 * self.dtheta)
+
+            progress('reconstruct_fan', a + 1, len(angles))
+
+        # ensure any data outside the reconstructed circle is set to invalid
+        X[:, (xi ** 2 + yi ** 2) > (samples/2)**2] = -1
+
+        return ((X - mu_water) / mu_water) * 1000
+
+    def reconstruct_all(self, file, method=None, alpha=None, workers=None, mu_water=None, multiframe=False):
         
         """ reconstruct_all( FILENAME, ALPHA ) creates a series of DICOM
         files for the Xtreme RSQ data. FILENAME is the base file name for
@@ -249,7 +534,17 @@ class Xtreme(object):
         specify how the data is reconstructed. Possible options are:
         'parallel' - reconstruct each slice separately using a fan to parallel
                            conversion
-        'fdk' - approximate FDK algorithm for better reconstruction"""
+        'fan' - reconstruct each slice separately using fan-beam filtered
+                  back-projection, without the fan to parallel conversion
+        'fdk' - approximate FDK algorithm for better reconstruction
+
+        WORKERS is the number of processes used to reconstruct slices in
+        parallel, which defaults to all processors, and MU_WATER is the
+        linear attenuation coefficient of water, per mm, used to convert to
+        Hounsfield units, which defaults to 0.02. If MULTIFRAME is True, all
+        slices are saved in a single Enhanced CT file instead of one file
+        per slice, which means that every slice is kept in memory, as 16 bit
+        pixels, until the end."""
                 
         if alpha is None:
             alpha = 0.001
@@ -257,30 +552,86 @@ class Xtreme(object):
         if method is None:
             method = 'parallel'
 
-        # set frame number and DICOM UIDs for saving to multiple frames
-        z = 1
-        seriesuid = pydicom.uid.generate_uid()
-        studyuid = pydicom.uid.generate_uid()
-        frameuid = pydicom.uid.generate_uid()
-        time = datetime.datetime.now()
+        if mu_water is None:
+            mu_water = 0.02
+
+        # frames are numbered from 1, with the same DICOM UIDs for every frame,
+        # and are saved while the next ones are reconstructed. The series is
+        # closed even if reconstruction fails, so no files are left half written
+        with DicomSeries(file, self.scale, self.scale, multiframe=multiframe) as series:
 
-        # main loop over each z-fan
-        for fan in range(0, self.scans, self.fan_scans):
             if method == 'fdk':
+
+                # main loop over each z-fan
+                for fan in range(0, self.scans, self.fan_scans):
                 
-                # correct reconstruction using FDK method, self.fan_scans scans at a time
-                pass
+                    # correct reconstruction using FDK method, self.fan_scans scans at a time
+                    with stage('reconstruct_fan', fan=fan):
+                        volume = self.reconstruct_fan(fan, alpha, mu_water)
+
+                    for X in volume:
+
+                        # save as dicom file
+                        with stage('create_dicom'):
+                            series.write(X)
             
             else:
 
-                # default method should reconstruct each slice separately
-                for scan in range(fan+self.skip_scans,fan+self.fan_scans-self.skip_scans):
-                    if (scan<self.scans):
+                # default method should reconstruct each slice separately, so all
+                # valid slices of every z-fan are spread across the workers
+                scans = [scan for fan in range(0, self.scans, self.fan_scans)
+                    for scan in range(fan+self.skip_scans,fan+self.fan_scans-self.skip_scans) if scan<self.scans]
 
-						# reconstruct scan
+                slices = self.reconstruct_slices(scans, alpha, mu_water, workers, 'fan' if method == 'fan' else None)
+                for done, X in enumerate(slices):
 
-						# save as dicom file
-                        z = z + 1
+                    # save as dicom file, in order as each one is finished
+                    with stage('create_dicom'):
+                        series.write(X)
+                    progress('reconstruct_all', done + 1, len(scans))
 
         return
 
+def write_rsq(filename, samples, scans=30, seed=0):
+
+    """ write_rsq(filename, samples, scans) writes a synthetic Xtreme RSQ file
+    with the given number of valid samples per angle and scans, and random
+    detections, for testing and timing the Xtreme functions. The number of
+    angles grows with samples, so that the fan geometry is the same for
+    every size."""
+
+    # samples, scans and angles are those of a scan at half resolution
+    left, right = 18, 8
+    recon = 5 * samples
+    dimx = samples + left + right
+    angles = 12 + 69 + recon
+
+    header = np.zeros(124, np.int32)
+    header[7] = dimx
+    header[8] = angles + 2
+    header[9] = scans
+    header[14] = 20
+    header[19] = 2 * dimx
+    header[20] = 60
+    header[123] = 3
+
+    rng = np.random.default_rng(seed)
+    with open(filename, 'wb') as f:
+        f.write(b'CTDATA-HEADER_V1')
+        f.write(header.tobytes())
+        f.write(b'\0' * ((header[123] + 1) * 512 - f.tell()))
+        for scan in range(scans):
+            f.write(rng.integers(100, 4000, size=(angles + 2, dimx)).astype(np.int16).tobytes())
+
+
+# each worker process opens the file once, and keeps it for every slice
+_worker = None
+
+def _open_worker(file):
+    global _worker
+    _worker = Xtreme(file)
+
+def _reconstruct_slice(scan, alpha, mu_water, method, memory=None):
+    if memory is None:
+        return _worker.reconstruct_slice(scan, alpha, mu_water, method), None
+    return traced(memory, _worker.reconstruct_slice, scan, alpha, mu_water, method)